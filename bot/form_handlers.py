@@ -53,7 +53,7 @@ async def _show_version(
     folder_id = data["form_folder_id"]
     folder_name = data["form_folder_name"]
 
-    versions = form_service.get_versions(folder_id, folder_name)
+    versions = await form_service.get_versions(folder_id, folder_name)
     await state.set_state(FormStates.viewing)
 
     if not versions:
@@ -88,7 +88,7 @@ async def _show_version(
 async def forms_start(
     message: Message, state: FSMContext, drive: DriveService, root_folder_id: str,
 ):
-    folders = drive.list_folders(root_folder_id)
+    folders = await drive.list_folders(root_folder_id)
     if not folders:
         await message.answer("Папки не найдены.", reply_markup=get_start_keyboard())
         return
@@ -172,14 +172,14 @@ async def toggle_pin(
     callback: CallbackQuery, state: FSMContext, form_service: FormService,
 ):
     data = await state.get_data()
-    versions = form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
+    versions = await form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
     if not versions:
         await callback.answer()
         return
 
     idx = _resolve_idx(data, len(versions))
     form = versions[idx]
-    new_state = form_service.toggle_pin(data["form_folder_id"], form.version)
+    new_state = await form_service.toggle_pin(data["form_folder_id"], form.version)
 
     await state.update_data(form_version_idx=None)
     await callback.answer("\U0001f4cc Закреплено" if new_state else "\U0001f4cd Откреплено")
@@ -198,7 +198,7 @@ async def edit_version_start(
     callback: CallbackQuery, state: FSMContext, form_service: FormService,
 ):
     data = await state.get_data()
-    versions = form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
+    versions = await form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
     if not versions:
         await callback.answer("Нет версии для редактирования", show_alert=True)
         return
@@ -217,7 +217,7 @@ async def delete_version_start(
     callback: CallbackQuery, state: FSMContext, form_service: FormService,
 ):
     data = await state.get_data()
-    versions = form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
+    versions = await form_service.get_versions(data["form_folder_id"], data["form_folder_name"])
     if not versions:
         await callback.answer("Нет версии для удаления", show_alert=True)
         return
@@ -238,7 +238,7 @@ async def delete_version_start(
 async def back_from_viewing(
     callback: CallbackQuery, state: FSMContext, drive: DriveService, root_folder_id: str,
 ):
-    folders = drive.list_folders(root_folder_id)
+    folders = await drive.list_folders(root_folder_id)
     await state.set_state(FormStates.selecting_folder)
     await state.update_data(form_folders=folders)
     await callback.message.edit_text(
@@ -265,7 +265,7 @@ async def receive_note(
     note = "" if message.text.strip() == "/skip" else message.text.strip()
     data = await state.get_data()
 
-    entry = form_service.create_version(
+    entry = await form_service.create_version(
         folder_id=data["form_folder_id"],
         folder_name=data["form_folder_name"],
         content=data["form_new_content"],
@@ -286,7 +286,7 @@ async def receive_edit(
     message: Message, state: FSMContext, form_service: FormService,
 ):
     data = await state.get_data()
-    result = form_service.edit_version(
+    result = await form_service.edit_version(
         folder_id=data["form_folder_id"],
         version=data["form_edit_version"],
         content=message.text,
@@ -309,7 +309,7 @@ async def confirm_delete(
 ):
     data = await state.get_data()
     ver = data["form_delete_version"]
-    ok = form_service.delete_version(data["form_folder_id"], ver)
+    ok = await form_service.delete_version(data["form_folder_id"], ver)
 
     await state.update_data(form_version_idx=None)
 
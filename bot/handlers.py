@@ -1,13 +1,12 @@
-import asyncio
-import io
 import os
-import zipfile
+from collections import Counter
 
-from aiogram import F, Router
+from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import BufferedInputFile, CallbackQuery, Message
+from aiogram.types import CallbackQuery, FSInputFile, Message
 
 from bot.keyboards import (
     CHOOSE_SHEETS,
@@ -18,10 +17,21 @@ from bot.keyboards import (
     get_start_keyboard,
     get_upload_folders_inline_keyboard,
 )
+from bot.progress import DownloadProgress
+from bot.upload_batch import DocumentCollector
+from services.archive_cache import ArchiveCache
+from services.download_scheduler import DownloadScheduler
 from services.drive_service import DriveService
+from services.form_service import FORM_FILENAMES
+from services.zip_archive import ZipArchive, plan_volumes
 
 router = Router()
 
+# Telegram → Drive uploads are streamed; the timeout covers the whole
+# transfer, which is paced by the Drive side
+TELEGRAM_CHUNK_SIZE = 256 * 1024
+TELEGRAM_DOWNLOAD_TIMEOUT = 600
+
 
 class SheetStates(StatesGroup):
     selecting_folders = State()
@@ -51,17 +61,32 @@ async def cmd_start(message: Message, state: FSMContext):
 async def choose_sheets(
     message: Message, state: FSMContext, drive: DriveService, root_folder_id: str
 ):
-    folders = drive.list_folders(root_folder_id)
-    if not folders:
-        await message.answer("Папки не найдены.", reply_markup=get_start_keyboard())
-        return
+    # The keyboard is shown with the first page of folders and grows as
+    # the rest of the listing arrives
+    folders: list[dict] = []
+    sent = None
+    async for page in drive.iter_folders(root_folder_id):
+        if not page:
+            continue
+        folders = folders + page
+        if sent is None:
+            await state.set_state(SheetStates.selecting_folders)
+            await state.update_data(folders=folders, selected_ids=[])
+            sent = await message.answer(
+                "Выберите папки для скачивания:",
+                reply_markup=get_folders_inline_keyboard(folders, []),
+            )
+            continue
+        if await state.get_state() != SheetStates.selecting_folders:
+            return  # the user has moved on
+        await state.update_data(folders=folders)
+        data = await state.get_data()
+        await sent.edit_reply_markup(
+            reply_markup=get_folders_inline_keyboard(folders, data["selected_ids"])
+        )
 
-    await state.set_state(SheetStates.selecting_folders)
-    await state.update_data(folders=folders, selected_ids=[])
-    await message.answer(
-        "Выберите папки для скачивания:",
-        reply_markup=get_folders_inline_keyboard(folders, []),
-    )
+    if sent is None:
+        await message.answer("Папки не найдены.", reply_markup=get_start_keyboard())
 
 
 @router.callback_query(SheetStates.selecting_folders, F.data.startswith("folder_toggle:"))
@@ -101,12 +126,22 @@ async def select_all_folders(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.callback_query(SheetStates.selecting_folders, F.data == "download_selected")
+@router.callback_query(
+    SheetStates.selecting_folders,
+    F.data.in_({"download_selected", "download_by_folder"}),
+)
 async def download_selected(
     callback: CallbackQuery,
     state: FSMContext,
     drive: DriveService,
+    download_scheduler: DownloadScheduler,
+    archive_cache: ArchiveCache,
+    archive_volume_max_bytes: int,
+    progress_interval: float,
 ):
+    # "download_by_folder": one archive per folder, each sent when its own
+    # files are done, instead of volumes packed across folders
+    by_folder = callback.data == "download_by_folder"
     data = await state.get_data()
     selected = list(data.get("selected_ids", []))
     folders = data["folders"]
@@ -118,66 +153,139 @@ async def download_selected(
     await callback.message.edit_text("Скачиваю файлы...")
     await callback.answer()
 
-    # Collect all download tasks across all selected folders (in selection order)
-    all_tasks = []
+    # List all selected folders at once (in selection order)
     folder_by_id = {f["id"]: f for f in folders}
     selected_folders = [folder_by_id[fid] for fid in selected if fid in folder_by_id]
     use_numbers = len(selected_folders) >= 2
-    folder_links = []
+    folder_links: dict[str, str] = {}
+    listed_folders = []
+
+    files_by_folder = await drive.list_files_many([f["id"] for f in selected_folders])
 
     for idx, folder in enumerate(selected_folders, 1):
-        files = drive.list_files(folder["id"])
+        # Sharded form storage keeps its files inside the piece's folder
+        files = [
+            f for f in files_by_folder[folder["id"]] if f["name"] not in FORM_FILENAMES
+        ]
         if not files:
             continue
         display_name = f"{idx}. {folder['name']}" if use_numbers else folder["name"]
         link = DriveService.get_folder_link(folder["id"])
-        folder_links.append(f'<a href="{link}">{display_name}</a>')
-        for file_meta in files:
-            all_tasks.append((display_name, file_meta))
+        folder_links[display_name] = f'<a href="{link}">{display_name}</a>'
+        listed_folders.append((folder["id"], display_name, files))
 
-    if not all_tasks:
+    if not listed_folders:
         await state.clear()
         await callback.message.edit_text("В выбранных папках нет файлов.")
         await callback.message.answer("Что дальше?", reply_markup=get_start_keyboard())
         return
 
-    async def _download(
-        folder_name: str, file_meta: dict
-    ) -> tuple[str, bytes, str] | str:
+    if by_folder:
+        volumes = [
+            volume
+            for _, display_name, files in listed_folders
+            for volume in plan_volumes([(display_name, files)], archive_volume_max_bytes)
+        ]
+    else:
+        volumes = plan_volumes(
+            [(display_name, files) for _, display_name, files in listed_folders],
+            archive_volume_max_bytes,
+        )
+    filenames = _volume_filenames(volumes, by_folder)
+    captions = [
+        _volume_caption(volume, folder_links, index, len(volumes))
+        for index, volume in enumerate(volumes)
+    ]
+
+    # Same selection, same file checksums — resend the archives Telegram has
+    archive_key = ArchiveCache.make_key(
+        listed_folders, "by_folder" if by_folder else ""
+    )
+    cached = archive_cache.get(archive_key) if archive_key else None
+    sent_ids = []
+    if cached and len(cached["file_ids"]) == len(volumes):
         try:
-            content, filename = await asyncio.to_thread(
-                drive.download_file, file_meta["id"]
+            for document_id, caption in zip(cached["file_ids"], captions):
+                await callback.message.answer_document(
+                    document_id, caption=caption, parse_mode="HTML"
+                )
+                sent_ids.append(document_id)
+        except TelegramBadRequest:
+            # Telegram forgot this file_id; volumes already sent are not
+            # built or sent again
+            archive_cache.drop(archive_key)
+        else:
+            await state.clear()
+            await callback.message.answer(
+                f"Отправлено файлов: {cached['count']}", reply_markup=get_start_keyboard()
             )
-            return folder_name, content, filename
-        except Exception as e:
-            return f"Не удалось скачать «{file_meta['name']}»: {e}"
-
-    results = await asyncio.gather(
-        *[_download(fn, fm) for fn, fm in all_tasks]
-    )
+            return
+
+    # A file may sit in several selected folders; download it once.
+    # Download order follows the volumes, so the first one is ready first
+    resume_from = len(sent_ids)
+    entries_by_id: dict[str, list[tuple[int, str]]] = {}
+    names_by_id: dict[str, str] = {}
+    for index, volume in enumerate(volumes):
+        if index < resume_from:
+            continue
+        for folder_name, file_meta in volume:
+            entries_by_id.setdefault(file_meta["id"], []).append((index, folder_name))
+            names_by_id[file_meta["id"]] = file_meta["name"]
+    pending = [
+        0 if index < resume_from else len(volume)
+        for index, volume in enumerate(volumes)
+    ]
+    progress = DownloadProgress(callback.message, len(entries_by_id), progress_interval)
 
-    buf = io.BytesIO()
     errors = []
-    total = 0
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for result in results:
-            if isinstance(result, str):
-                errors.append(result)
-                continue
-            folder_name, content, filename = result
-            zf.writestr(f"{folder_name}/{filename}", content)
-            total += 1
+    total = sum(len(volume) for volume in volumes[:resume_from])
+    next_volume = resume_from
+    archives = [ZipArchive() for _ in volumes]
+    try:
+        # Each file goes into its volume as soon as it arrives, then its
+        # bytes are dropped
+        async for file_id, result in download_scheduler.download_many(
+            callback.from_user.id, list(entries_by_id)
+        ):
+            size = 0
+            if isinstance(result, Exception):
+                errors.append(f"Не удалось скачать «{names_by_id[file_id]}»: {result}")
+            else:
+                content, filename = result
+                for index, folder_name in entries_by_id[file_id]:
+                    await archives[index].add(f"{folder_name}/{filename}", content)
+                size = len(content)
+                del content, result
+            await progress.advance(size)
+            for index, _ in entries_by_id[file_id]:
+                pending[index] -= 1
+
+            # Send finished volumes in order, without waiting for the rest
+            while next_volume < len(volumes) and not pending[next_volume]:
+                archive = archives[next_volume]
+                archive.close()
+                if archive.count:
+                    sent = await callback.message.answer_document(
+                        FSInputFile(archive.path, filename=filenames[next_volume]),
+                        caption=captions[next_volume],
+                        parse_mode="HTML",
+                    )
+                    sent_ids.append(sent.document.file_id)
+                    total += archive.count
+                archive.remove()
+                next_volume += 1
+    finally:
+        for archive in archives:
+            archive.remove()
+
+    await progress.finish()
 
     for err in errors:
         await callback.message.answer(err)
 
-    if total > 0:
-        buf.seek(0)
-        caption = "Папки:\n" + "\n".join(folder_links)
-        doc = BufferedInputFile(buf.getvalue(), filename="ноты.zip")
-        await callback.message.answer_document(
-            doc, caption=caption, parse_mode="HTML"
-        )
+    if archive_key and not errors and len(sent_ids) == len(volumes):
+        archive_cache.put(archive_key, sent_ids, total)
 
     await state.clear()
     await callback.message.answer(
@@ -185,6 +293,34 @@ async def download_selected(
     )
 
 
+def _volume_filenames(volumes: list[list[tuple[str, dict]]], by_folder: bool) -> list[str]:
+    if not by_folder:
+        if len(volumes) == 1:
+            return ["ноты.zip"]
+        return [f"ноты_{index}.zip" for index in range(1, len(volumes) + 1)]
+
+    # Archive named after its folder; a folder split into volumes gets _1, _2...
+    folder_names = [volume[0][0] for volume in volumes]
+    counts = Counter(folder_names)
+    seen: Counter[str] = Counter()
+    filenames = []
+    for name in folder_names:
+        seen[name] += 1
+        suffix = f"_{seen[name]}" if counts[name] > 1 else ""
+        filenames.append(f"{name}{suffix}.zip")
+    return filenames
+
+
+def _volume_caption(
+    volume: list[tuple[str, dict]], folder_links: dict[str, str], index: int, count: int
+) -> str:
+    names = list(dict.fromkeys(folder_name for folder_name, _ in volume))
+    caption = "Папки:\n" + "\n".join(folder_links[name] for name in names)
+    if count > 1:
+        caption = f"Часть {index + 1} из {count}\n" + caption
+    return caption
+
+
 # ── Upload flow ──
 
 
@@ -192,7 +328,7 @@ async def download_selected(
 async def upload_sheets(
     message: Message, state: FSMContext, drive: DriveService, root_folder_id: str
 ):
-    folders = drive.list_folders(root_folder_id)
+    folders = await drive.list_folders(root_folder_id)
     await state.set_state(SheetStates.choosing_upload_folder)
     await state.update_data(folders=folders)
     await message.answer(
@@ -238,7 +374,7 @@ async def create_upload_folder_finish(
         await message.answer("Название не может быть пустым. Попробуйте ещё раз.")
         return
 
-    folder = drive.create_folder(folder_name, root_folder_id)
+    folder = await drive.create_folder(folder_name, root_folder_id)
     await state.set_state(SheetStates.waiting_for_files)
     await state.update_data(
         upload_folder_id=folder["id"], upload_folder_name=folder["name"]
@@ -249,7 +385,21 @@ async def create_upload_folder_finish(
 
 
 @router.message(SheetStates.waiting_for_files, F.document)
-async def receive_file(message: Message, state: FSMContext):
+async def receive_file(
+    message: Message,
+    state: FSMContext,
+    drive: DriveService,
+    document_collector: DocumentCollector,
+    upload_concurrency: int,
+):
+    # Several documents at once are uploaded together under their own names
+    batch = await document_collector.collect(message)
+    if batch is None:
+        return
+    if len(batch) > 1:
+        await _upload_batch(message, state, drive, batch, upload_concurrency)
+        return
+
     doc = message.document
     original_name = doc.file_name or "file"
     ext = os.path.splitext(original_name)[1]
@@ -308,6 +458,16 @@ async def receive_new_filename(
     await _do_upload_from_message(message, state, drive, new_name)
 
 
+async def _telegram_stream(bot: Bot, file_id: str):
+    """Telegram document as an async stream of byte chunks."""
+    file = await bot.get_file(file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    async for chunk in bot.session.stream_content(
+        url, timeout=TELEGRAM_DOWNLOAD_TIMEOUT, chunk_size=TELEGRAM_CHUNK_SIZE
+    ):
+        yield chunk
+
+
 async def _do_upload(
     callback: CallbackQuery,
     state: FSMContext,
@@ -318,9 +478,7 @@ async def _do_upload(
     file_id = data["pending_file_id"]
     folder_id = data["upload_folder_id"]
 
-    file = await callback.bot.download(file_id)
-    content = file.read()
-    drive.upload_file(content, filename, folder_id)
+    await drive.upload_stream(_telegram_stream(callback.bot, file_id), filename, folder_id)
 
     await state.set_state(SheetStates.waiting_for_files)
     await callback.message.edit_text(f"Файл «{filename}» загружен!")
@@ -341,9 +499,7 @@ async def _do_upload_from_message(
     file_id = data["pending_file_id"]
     folder_id = data["upload_folder_id"]
 
-    file = await message.bot.download(file_id)
-    content = file.read()
-    drive.upload_file(content, filename, folder_id)
+    await drive.upload_stream(_telegram_stream(message.bot, file_id), filename, folder_id)
 
     await state.set_state(SheetStates.waiting_for_files)
     await message.answer(f"Файл «{filename}» загружен!")
@@ -353,6 +509,36 @@ async def _do_upload_from_message(
     )
 
 
+async def _upload_batch(
+    message: Message,
+    state: FSMContext,
+    drive: DriveService,
+    batch: list[Message],
+    concurrency: int,
+):
+    data = await state.get_data()
+    folder_id = data["upload_folder_id"]
+
+    status = await message.answer(f"Загружаю файлы: {len(batch)}...")
+    uploads = [
+        (m.document.file_name or "file", _telegram_stream(m.bot, m.document.file_id))
+        for m in batch
+    ]
+    results = await drive.upload_many(uploads, folder_id, concurrency=concurrency)
+
+    failed = [
+        f"Не удалось загрузить «{filename}»: {result}"
+        for (filename, _), result in zip(uploads, results)
+        if isinstance(result, Exception)
+    ]
+    summary = f"Загружено файлов: {len(batch) - len(failed)} из {len(batch)}"
+    await status.edit_text("\n".join([summary, *failed]))
+    await message.answer(
+        "Отправьте ещё файлы или нажмите «Готово».",
+        reply_markup=get_more_files_keyboard(),
+    )
+
+
 @router.callback_query(SheetStates.waiting_for_files, F.data == "upload_more")
 async def upload_more(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("Отправьте файл (документ).")
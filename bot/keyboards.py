@@ -53,6 +53,13 @@ def get_folders_inline_keyboard(
             ),
         ]
     )
+    buttons.append(
+        [
+            InlineKeyboardButton(
+                text="Скачать по папкам", callback_data="download_by_folder"
+            )
+        ]
+    )
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
@@ -0,0 +1,44 @@
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+
+def format_size(size: int) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} КБ"
+    return f"{size / (1024 * 1024):.1f} МБ"
+
+
+class DownloadProgress:
+    """Status message of a batch download, edited at most once per
+    `interval` seconds no matter how fast files arrive."""
+
+    def __init__(self, message: Message, total: int, interval: float = 3.0):
+        self._message = message
+        self._total = total
+        self._interval = interval
+        self._last_edit = time.monotonic()
+        self.done = 0
+        self.received = 0
+
+    async def advance(self, size: int):
+        self.done += 1
+        self.received += size
+        if time.monotonic() - self._last_edit >= self._interval:
+            await self._edit("Скачиваю файлы")
+
+    async def finish(self):
+        await self._edit("Скачано файлов")
+
+    async def _edit(self, prefix: str):
+        self._last_edit = time.monotonic()
+        text = (
+            f"{prefix}: {self.done} из {self._total}, "
+            f"{format_size(self.received)}"
+        )
+        try:
+            await self._message.edit_text(text)
+        except (TelegramBadRequest, TelegramRetryAfter):
+            # Unchanged text or flood control: the next edit catches up
+            pass
@@ -0,0 +1,26 @@
+import asyncio
+
+from aiogram.types import Message
+
+
+class DocumentCollector:
+    """Groups documents a user sends in one go (an album, or several files
+    in quick succession) into one batch.
+
+    Each message waits `window` seconds; the handler of the last one to
+    arrive gets the whole batch, the others get None."""
+
+    def __init__(self, window: float = 1.5):
+        self._window = window
+        # {(chat_id, user_id): messages of the batch being collected}
+        self._batches: dict[tuple[int, int], list[Message]] = {}
+
+    async def collect(self, message: Message) -> list[Message] | None:
+        key = (message.chat.id, message.from_user.id)
+        batch = self._batches.setdefault(key, [])
+        batch.append(message)
+        await asyncio.sleep(self._window)
+        if batch[-1] is not message:
+            return None
+        del self._batches[key]
+        return sorted(batch, key=lambda m: m.message_id)
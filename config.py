@@ -7,3 +7,61 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID", "")
 CREDENTIALS_PATH = os.getenv("CREDENTIALS_PATH", "credentials.json")
+
+# Change feed polling: how often the background watcher reads Drive changes,
+# and how stale cached listings may get before a read syncs inline
+DRIVE_CHANGES_POLL_INTERVAL = float(os.getenv("DRIVE_CHANGES_POLL_INTERVAL", "10"))
+DRIVE_MAX_STALENESS = float(os.getenv("DRIVE_MAX_STALENESS", "60"))
+
+# How often the watcher logs cache and retry statistics, seconds
+DRIVE_STATS_LOG_INTERVAL = float(os.getenv("DRIVE_STATS_LOG_INTERVAL", "600"))
+
+# files.list page size (Drive allows up to 1000)
+DRIVE_PAGE_SIZE = int(os.getenv("DRIVE_PAGE_SIZE", "1000"))
+
+# In-memory file content cache budget
+DRIVE_MEMORY_CACHE_MAX_MB = int(os.getenv("DRIVE_MEMORY_CACHE_MAX_MB", "200"))
+
+# Persistent file content cache (survives restarts), keyed by md5Checksum
+DRIVE_CACHE_DIR = os.getenv("DRIVE_CACHE_DIR", "cache/files")
+DRIVE_DISK_CACHE_MAX_MB = int(os.getenv("DRIVE_DISK_CACHE_MAX_MB", "1024"))
+
+# Client-side Drive quota (requests per second) shared by all users
+DRIVE_METADATA_QPS = float(os.getenv("DRIVE_METADATA_QPS", "10"))
+DRIVE_MEDIA_QPS = float(os.getenv("DRIVE_MEDIA_QPS", "10"))
+DRIVE_RATE_BURST = int(os.getenv("DRIVE_RATE_BURST", "20"))
+
+# Batch download scheduler: downloads in flight overall and per user
+DOWNLOAD_MAX_CONCURRENCY = int(os.getenv("DOWNLOAD_MAX_CONCURRENCY", "8"))
+DOWNLOAD_PER_USER_CONCURRENCY = int(os.getenv("DOWNLOAD_PER_USER_CONCURRENCY", "4"))
+# Downloads of one batch running or waiting to be taken by its consumer, so a
+# slow archive upload does not pile file contents up in memory
+DOWNLOAD_MAX_BUFFERED = int(os.getenv("DOWNLOAD_MAX_BUFFERED", "8"))
+
+# Batch archives are split into volumes of at most this size (Telegram bots
+# may upload documents up to 50 MB)
+ARCHIVE_VOLUME_MAX_MB = int(os.getenv("ARCHIVE_VOLUME_MAX_MB", "48"))
+
+# Telegram file_id of already-sent archives, reused for identical selections
+ARCHIVE_CACHE_PATH = os.getenv("ARCHIVE_CACHE_PATH", "cache/archives.json")
+
+# Minimum seconds between edits of the batch download status message
+DOWNLOAD_PROGRESS_INTERVAL = float(os.getenv("DOWNLOAD_PROGRESS_INTERVAL", "3"))
+
+# Documents sent within this many seconds of each other are uploaded as one
+# batch, at most UPLOAD_MAX_CONCURRENCY at a time
+UPLOAD_BATCH_WINDOW = float(os.getenv("UPLOAD_BATCH_WINDOW", "1.5"))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+
+# Form storage: "single" — one формы.csv in the root folder; "sharded" — one
+# per piece folder (migrate with migrate_forms.py)
+FORMS_STORAGE = os.getenv("FORMS_STORAGE", "single")
+
+# Form edits go to a journal next to формы.csv; it is folded into the CSV
+# this often (seconds), or as soon as it holds this many entries
+FORMS_COMPACT_INTERVAL = float(os.getenv("FORMS_COMPACT_INTERVAL", "600"))
+FORMS_JOURNAL_MAX_ENTRIES = int(os.getenv("FORMS_JOURNAL_MAX_ENTRIES", "50"))
+
+# Form edits made within this many seconds are written to Drive together
+# (0 writes every edit immediately)
+FORMS_WRITE_DELAY = float(os.getenv("FORMS_WRITE_DELAY", "2"))
@@ -1,33 +1,81 @@
 import asyncio
 import logging
+import time
 
 from aiogram import Bot, Dispatcher
 
 import config
 from bot.form_handlers import router as form_router
 from bot.handlers import router
+from bot.upload_batch import DocumentCollector
+from services.archive_cache import ArchiveCache
+from services.content_cache import DiskContentCache
+from services.download_scheduler import DownloadScheduler
 from services.form_service import FormService
 from services.drive_service import DriveService
 
+logger = logging.getLogger(__name__)
+
 
 async def main():
+    started = time.perf_counter()
     logging.basicConfig(level=logging.INFO)
-    logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
 
     bot = Bot(token=config.BOT_TOKEN)
     dp = Dispatcher()
 
-    drive = DriveService(config.CREDENTIALS_PATH)
+    drive = DriveService(
+        config.CREDENTIALS_PATH,
+        poll_interval=config.DRIVE_CHANGES_POLL_INTERVAL,
+        max_staleness=config.DRIVE_MAX_STALENESS,
+        memory_cache_max_bytes=config.DRIVE_MEMORY_CACHE_MAX_MB * 1024 * 1024,
+        disk_cache=DiskContentCache(
+            config.DRIVE_CACHE_DIR, config.DRIVE_DISK_CACHE_MAX_MB * 1024 * 1024,
+        ),
+        page_size=config.DRIVE_PAGE_SIZE,
+        metadata_qps=config.DRIVE_METADATA_QPS,
+        media_qps=config.DRIVE_MEDIA_QPS,
+        rate_burst=config.DRIVE_RATE_BURST,
+        stats_interval=config.DRIVE_STATS_LOG_INTERVAL,
+    )
+    await drive.start()
 
-    form_service = FormService(drive, config.GOOGLE_DRIVE_FOLDER_ID)
+    form_service = FormService(
+        drive,
+        config.GOOGLE_DRIVE_FOLDER_ID,
+        storage=config.FORMS_STORAGE,
+        compact_interval=config.FORMS_COMPACT_INTERVAL,
+        journal_max_entries=config.FORMS_JOURNAL_MAX_ENTRIES,
+        write_delay=config.FORMS_WRITE_DELAY,
+    )
+    await form_service.start()
+    download_scheduler = DownloadScheduler(
+        drive,
+        max_concurrency=config.DOWNLOAD_MAX_CONCURRENCY,
+        per_user_concurrency=config.DOWNLOAD_PER_USER_CONCURRENCY,
+        max_buffered=config.DOWNLOAD_MAX_BUFFERED,
+    )
 
     dp.include_router(form_router)
     dp.include_router(router)
     dp["drive"] = drive
     dp["root_folder_id"] = config.GOOGLE_DRIVE_FOLDER_ID
     dp["form_service"] = form_service
+    dp["download_scheduler"] = download_scheduler
+    dp["archive_cache"] = ArchiveCache(config.ARCHIVE_CACHE_PATH)
+    dp["archive_volume_max_bytes"] = config.ARCHIVE_VOLUME_MAX_MB * 1024 * 1024
+    dp["progress_interval"] = config.DOWNLOAD_PROGRESS_INTERVAL
+    dp["document_collector"] = DocumentCollector(config.UPLOAD_BATCH_WINDOW)
+    dp["upload_concurrency"] = config.UPLOAD_MAX_CONCURRENCY
 
-    await dp.start_polling(bot)
+    logger.info("Запуск занял %.0f мс", (time.perf_counter() - started) * 1000)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        try:
+            await form_service.close()
+        finally:
+            await drive.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+Перенос форм из общего формы.csv (в корневой папке) в отдельные файлы
+внутри папок произведений — для FORMS_STORAGE=sharded.
+
+Журнал изменений учитывается. Корневой формы.csv не меняется и остаётся
+резервной копией. Бот на время переноса должен быть остановлен.
+
+Запуск:
+    python migrate_forms.py --dry-run
+    python migrate_forms.py [--force]
+"""
+
+import argparse
+import asyncio
+
+import config
+from services.drive_service import DriveService
+from services.form_service import (
+    CSV_FILENAME,
+    CSV_MIME,
+    JOURNAL_FILENAME,
+    _encode_csv,
+    _FormIndex,
+    _parse_csv,
+    _parse_journal,
+)
+
+
+async def read_text(drive: DriveService, folder_id: str, filename: str) -> str:
+    file_info = await drive.find_file_by_name(folder_id, filename)
+    if not file_info:
+        return ""
+    content, _ = await drive.download_file(file_info["id"])
+    return content.decode("utf-8-sig")
+
+
+async def migrate(dry_run: bool, force: bool):
+    drive = DriveService(config.CREDENTIALS_PATH)
+    root_id = config.GOOGLE_DRIVE_FOLDER_ID
+    try:
+        rows = _FormIndex(
+            _parse_csv(await read_text(drive, root_id, CSV_FILENAME)),
+            None,
+            _parse_journal(await read_text(drive, root_id, JOURNAL_FILENAME)),
+        ).rows
+        print(f"Записей в общем файле: {len(rows)}")
+
+        folders = await drive.list_folders(root_id)
+        folder_ids = {f["id"] for f in folders}
+        id_by_name = {f["name"]: f["id"] for f in folders}
+
+        shards: dict[str, list] = {}
+        for r in rows:
+            # Old rows may carry only a matching folder name
+            target = r.folder_id if r.folder_id in folder_ids else id_by_name.get(r.folder_name)
+            if target is None:
+                print(f"  ! папка не найдена: «{r.folder_name}» ({r.folder_id}), версия {r.version}")
+                continue
+            r.folder_id = target
+            shards.setdefault(target, []).append(r)
+
+        for folder_id, shard_rows in shards.items():
+            name = shard_rows[0].folder_name
+            existing = await drive.find_file_by_name(folder_id, CSV_FILENAME)
+            if existing and not force:
+                print(f"  - «{name}»: {CSV_FILENAME} уже есть, пропускаю (--force)")
+                continue
+            print(f"  + «{name}»: {len(shard_rows)} версий")
+            if dry_run:
+                continue
+            data = _encode_csv(shard_rows)
+            if existing:
+                await drive.update_file(existing["id"], data, CSV_MIME)
+            else:
+                await drive.upload_file(data, CSV_FILENAME, folder_id)
+
+        if dry_run:
+            print("Пробный запуск: ничего не записано.")
+        else:
+            print("Готово. Включите FORMS_STORAGE=sharded и запустите бота.")
+    finally:
+        await drive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="только показать план")
+    parser.add_argument(
+        "--force", action="store_true", help="перезаписать уже существующие файлы в папках",
+    )
+    args = parser.parse_args()
+    asyncio.run(migrate(args.dry_run, args.force))
+
+
+if __name__ == "__main__":
+    main()
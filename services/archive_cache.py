@@ -0,0 +1,75 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveCache:
+    """Telegram file_ids of archives already sent, so an identical selection
+    is answered by resending the documents instead of rebuilding them.
+
+    The key covers the ordered folder selection and every entry's path and
+    md5Checksum, so any change on Drive produces a new key. Kept as a small
+    LRU in a JSON file to survive restarts."""
+
+    def __init__(self, path: str, max_entries: int = 500):
+        self._path = path
+        self._max_entries = max_entries
+        # {key: {"file_ids": [str, ...], "count": int}}, one file_id per
+        # volume, least recently used first
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._load()
+
+    @staticmethod
+    def make_key(
+        folders: list[tuple[str, str, list[dict]]], variant: str = ""
+    ) -> str | None:
+        """folders: (folder_id, display_name, files) in selection order;
+        variant tells apart differently packed archives of the same files.
+        None if some file has no checksum (e.g. Google Docs)."""
+        material: list = [variant]
+        for folder_id, display_name, files in folders:
+            checksums = []
+            for f in files:
+                if not f.get("md5Checksum"):
+                    return None
+                checksums.append([f["id"], f["name"], f["md5Checksum"]])
+            material.append([folder_id, display_name, checksums])
+        raw = json.dumps(material, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                self._entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            return
+        except (ValueError, TypeError):
+            logger.warning("Кеш архивов повреждён, начинаю с пустого: %s", self._path)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self._path)
+
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, file_ids: list[str], count: int):
+        self._entries[key] = {"file_ids": file_ids, "count": count}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        self._save()
+
+    def drop(self, key: str):
+        if self._entries.pop(key, None) is not None:
+            self._save()
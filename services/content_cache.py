@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TMP_SUFFIX = ".tmp"
+
+
+class DiskContentCache:
+    """Content-addressed file cache keyed by Drive md5Checksum.
+
+    Survives restarts. Total size is kept under max_bytes by evicting the
+    least recently used blobs (recency = file mtime, bumped on every hit).
+    Thread-safe; callers run it via asyncio.to_thread."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # {md5: size}, least recently used first
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, md5: str) -> str:
+        return os.path.join(self._dir, md5)
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self._dir):
+            path = self._path(name)
+            if name.endswith(TMP_SUFFIX):
+                # Leftover of an interrupted write
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+        with self._lock:
+            self._evict()
+        logger.info("Дисковый кеш: %d файлов, %.1f МБ",
+                    len(self._index), self._total / 1024 / 1024)
+
+    def _evict(self):
+        while self._total > self._max_bytes and self._index:
+            md5, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._path(md5))
+            except FileNotFoundError:
+                pass
+
+    def _drop(self, md5: str):
+        with self._lock:
+            size = self._index.pop(md5, None)
+            if size is not None:
+                self._total -= size
+
+    def get(self, md5: str) -> bytes | None:
+        with self._lock:
+            if md5 not in self._index:
+                return None
+            self._index.move_to_end(md5)
+
+        path = self._path(md5)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._drop(md5)
+            return None
+
+        if hashlib.md5(content).hexdigest() != md5:
+            logger.warning("Дисковый кеш: битый файл %s, удаляю", md5)
+            self._drop(md5)
+            os.remove(path)
+            return None
+        return content
+
+    def put(self, md5: str, content: bytes):
+        if len(content) > self._max_bytes:
+            return
+        with self._lock:
+            if md5 in self._index:
+                self._index.move_to_end(md5)
+                return
+
+        path = self._path(md5)
+        tmp_path = f"{path}.{threading.get_ident()}{TMP_SUFFIX}"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if md5 not in self._index:
+                self._index[md5] = len(content)
+                self._total += len(content)
+            self._evict()
+
+
+class MemoryContentCache:
+    """In-memory LRU of file contents with a byte budget.
+
+    Entries are {"content": bytes, "filename": str, "md5": str | None}.
+    Thread-safe, so it can be shared with worker threads."""
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # {file_id: entry}, least recently used first
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_id: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+            return entry
+
+    def peek(self, file_id: str) -> dict | None:
+        """Lookup without touching recency or counters."""
+        with self._lock:
+            return self._entries.get(file_id)
+
+    def put(self, file_id: str, content: bytes, filename: str, md5: str | None):
+        size = len(content)
+        with self._lock:
+            self._pop(file_id)
+            if size > self._max_bytes:
+                return
+            self._entries[file_id] = {
+                "content": content, "filename": filename, "md5": md5,
+            }
+            self._total += size
+            while self._total > self._max_bytes:
+                evicted_id, _ = self._pop_lru()
+                self.evictions += 1
+                logger.debug("Кеш в памяти: вытеснен %s", evicted_id)
+
+    def pop(self, file_id: str):
+        with self._lock:
+            self._pop(file_id)
+
+    def _pop(self, file_id: str):
+        entry = self._entries.pop(file_id, None)
+        if entry is not None:
+            self._total -= len(entry["content"])
+
+    def _pop_lru(self) -> tuple[str, dict]:
+        file_id, entry = self._entries.popitem(last=False)
+        self._total -= len(entry["content"])
+        return file_id, entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "max_bytes": self._max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+
+from services.drive_service import DriveService
+from services.rate_limiter import BULK
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Batch:
+    results: asyncio.Queue = field(default_factory=asyncio.Queue)
+    cancelled: bool = False
+    # Started downloads whose result the consumer has not taken yet
+    unconsumed: int = 0
+
+
+@dataclass
+class _Job:
+    file_id: str
+    batch: _Batch
+    enqueued_at: float
+
+
+class DownloadScheduler:
+    """Runs batch downloads of all users through one bounded pool.
+
+    At most max_concurrency downloads run at once and at most
+    per_user_concurrency of them belong to one user. Free slots are handed
+    to users round-robin, so a 200-file request does not starve a 3-file one.
+    A batch holds at most max_buffered started or finished downloads its
+    consumer has not taken yet; a slow consumer pauses its own batch
+    instead of piling file contents up in memory."""
+
+    def __init__(
+        self,
+        drive: DriveService,
+        max_concurrency: int = 8,
+        per_user_concurrency: int = 4,
+        max_buffered: int = 8,
+    ):
+        self._drive = drive
+        self._max_concurrency = max_concurrency
+        self._per_user_concurrency = per_user_concurrency
+        self._max_buffered = max_buffered
+        self._queues: dict[int, deque[_Job]] = {}
+        # Users with queued jobs, in round-robin order
+        self._turns: deque[int] = deque()
+        self._running: Counter[int] = Counter()
+        self._active = 0
+        self._tasks: set[asyncio.Task] = set()
+
+        self.started = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(len(q) for q in self._queues.values()),
+            "running": self._active,
+            "users": len(self._turns),
+            "completed": self.completed,
+            "avg_wait": self.total_wait / self.started if self.started else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def download_many(self, user_id: int, file_ids: list[str]):
+        """Yield (file_id, result) as each download completes; result is
+        (content, filename) or the raised exception."""
+        batch = _Batch()
+        now = time.monotonic()
+        queue = self._queues.setdefault(user_id, deque())
+        queue.extend(_Job(fid, batch, now) for fid in file_ids)
+        if user_id not in self._turns:
+            self._turns.append(user_id)
+
+        stats = self.stats()
+        logger.info(
+            "Очередь загрузок: +%d от %s, в очереди %d, выполняется %d, "
+            "среднее ожидание %.1fs",
+            len(file_ids), user_id, stats["queued"], stats["running"], stats["avg_wait"],
+        )
+        self._pump()
+
+        try:
+            for _ in file_ids:
+                result = await batch.results.get()
+                batch.unconsumed -= 1
+                self._pump()
+                yield result
+        finally:
+            # Consumer gone (error or cancel) — drop what has not started yet
+            batch.cancelled = True
+
+    def _pump(self):
+        while self._active < self._max_concurrency and self._turns:
+            for _ in range(len(self._turns)):
+                user_id = self._turns[0]
+                self._turns.rotate(-1)
+                job = self._next_job(user_id)
+                if job is not None:
+                    self._start(user_id, job)
+                    break
+            else:
+                # Every waiting user is at their own limit or waits for
+                # their consumer
+                return
+
+    def _next_job(self, user_id: int) -> _Job | None:
+        if self._running[user_id] >= self._per_user_concurrency:
+            return None
+        queue = self._queues[user_id]
+        while queue and queue[0].batch.cancelled:
+            queue.popleft()
+        if queue and queue[0].batch.unconsumed >= self._max_buffered:
+            return None
+        job = queue.popleft() if queue else None
+        if not queue:
+            del self._queues[user_id]
+            self._turns.remove(user_id)
+        return job
+
+    def _start(self, user_id: int, job: _Job):
+        self._active += 1
+        job.batch.unconsumed += 1
+        self._running[user_id] += 1
+        self.started += 1
+        wait = time.monotonic() - job.enqueued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        task = asyncio.create_task(self._run(user_id, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, user_id: int, job: _Job):
+        try:
+            result = await self._drive.download_file(job.file_id, priority=BULK)
+        except Exception as e:
+            result = e
+        finally:
+            self._active -= 1
+            self._running[user_id] -= 1
+            if not self._running[user_id]:
+                del self._running[user_id]
+            self.completed += 1
+            self._pump()
+        job.batch.results.put_nowait((job.file_id, result))
@@ -1,151 +1,562 @@
-import io
+import asyncio
+import contextlib
+import email.utils
+import hashlib
+import json
 import logging
-import threading
 import time
+import uuid
+from datetime import datetime, timezone
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+import aiohttp
+from google.auth import crypt, jwt
+
+from services.content_cache import DiskContentCache, MemoryContentCache
+from services.rate_limiter import BULK, INTERACTIVE, TokenBucket
+from services.retry import RetryMetrics, RetryPolicy, retry
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 logger = logging.getLogger(__name__)
 
-MAX_RETRIES = 3
-RETRY_DELAYS = (1, 2, 4)
+API_URL = "https://www.googleapis.com/drive/v3"
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3"
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+JWT_GRANT_TYPE = "urn:ietf:params:oauth:grant-type:jwt-bearer"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+CHANGES_PAGE_SIZE = 100
+CHANGES_FIELDS = (
+    "nextPageToken,newStartPageToken,"
+    "changes(fileId,removed,file(mimeType,parents,trashed,md5Checksum))"
+)
+
+# Folders per OR'ed 'in parents' query in list_files_many
+LIST_MANY_CHUNK = 20
+
+RETRY_POLICIES = {
+    "connection": RetryPolicy(max_attempts=4, base_delay=1, max_delay=8),
+    # 429 and 403 rate limit reasons: Drive asks for exponential backoff
+    "rate_limit": RetryPolicy(max_attempts=6, base_delay=1, max_delay=32),
+    "server": RetryPolicy(max_attempts=5, base_delay=1, max_delay=16),
+}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+SERVER_ERROR_STATUSES = {500, 502, 503, 504}
+
+# Connection pool shared by all requests of one DriveService
+HTTP_POOL_SIZE = 20
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=30, sock_read=60)
+
+# Resumable uploads go in chunks of this size (must be a multiple of 256 KiB);
+# memory per upload stays at about one chunk
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# update_file(base_revision=...): the revision list may lag behind a write;
+# it is re-read this many times, with doubling pauses, until ours shows up
+REVISION_LIST_ATTEMPTS = 5
+REVISION_LIST_DELAY = 0.5
+
+# Access tokens live 1 hour; refresh a bit earlier
+TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = 60
+
+
+class DriveApiError(Exception):
+    """Non-2xx response from the Drive API."""
+
+    def __init__(
+        self,
+        status: int,
+        message: str,
+        reason: str = "",
+        retry_after: float | None = None,
+    ):
+        super().__init__(f"Drive API {status}: {message}")
+        self.status = status
+        self.message = message
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RevisionConflict(Exception):
+    """A conditional update landed, but not on top of the expected revision:
+    someone else wrote the file in between and their revision was
+    overwritten. previous_id is None when the revision list doesn't show
+    which revision ours replaced."""
+
+    def __init__(self, file_id: str, revision_id: str, previous_id: str | None):
+        super().__init__(
+            f"File {file_id}: revision {revision_id} follows {previous_id}, "
+            "not the expected base"
+        )
+        self.file_id = file_id
+        self.revision_id = revision_id
+        self.previous_id = previous_id
 
 
-def _with_retry(func):
-    """Retry on transient connection errors."""
-    for attempt in range(MAX_RETRIES):
-        try:
-            return func()
-        except ConnectionError as e:
-            if attempt == MAX_RETRIES - 1:
-                raise
-            delay = RETRY_DELAYS[attempt]
-            logger.warning("Connection error (attempt %d/%d), retrying in %ds: %s",
-                           attempt + 1, MAX_RETRIES, delay, e)
-            time.sleep(delay)
+def _parse_retry_after(value: str | None) -> float | None:
+    """Retry-After is either delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+async def _raise_for_status(resp: aiohttp.ClientResponse) -> None:
+    if resp.status < 400:
+        return
+    reason = ""
+    try:
+        payload = await resp.json(content_type=None)
+        error = payload["error"]
+        message = error["message"]
+        reason = (error.get("errors") or [{}])[0].get("reason", "")
+    except (ValueError, KeyError, TypeError, AttributeError, aiohttp.ContentTypeError):
+        message = resp.reason or ""
+    raise DriveApiError(
+        resp.status, message, reason,
+        _parse_retry_after(resp.headers.get("Retry-After")),
+    )
+
+
+def _error_class(e: Exception) -> str | None:
+    """Map an exception to a retry policy name; None means don't retry."""
+    if isinstance(e, (ConnectionError, aiohttp.ClientConnectionError,
+                      aiohttp.ClientPayloadError, asyncio.TimeoutError)):
+        return "connection"
+    if isinstance(e, DriveApiError):
+        if e.status == 429 or (e.status == 403 and e.reason in RATE_LIMIT_REASONS):
+            return "rate_limit"
+        if e.status in SERVER_ERROR_STATUSES:
+            return "server"
+    return None
+
+
+def _create_error_class(e: Exception) -> str | None:
+    """Retry policy for requests that create something (POST). Only
+    retried if Drive certainly did not act on them: the connection was
+    never made, or the request was rejected by the rate limiter. After a
+    timeout or a 5xx the file may already exist, so a retry would make a
+    duplicate."""
+    if isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)):
+        return "connection"
+    if isinstance(e, DriveApiError):
+        if e.status == 429 or (e.status == 403 and e.reason in RATE_LIMIT_REASONS):
+            return "rate_limit"
+    return None
+
+
+def _multipart_body(metadata: dict, content: bytes, mime_type: str) -> tuple[bytes, str]:
+    """Build a multipart/related body for uploadType=multipart."""
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+        f"{json.dumps(metadata)}\r\n"
+        f"--{boundary}\r\n"
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return head + content + tail, f"multipart/related; boundary={boundary}"
+
+
+async def _fixed_chunks(chunks, size: int):
+    """Re-cut an async byte stream into size-byte chunks. Yields
+    (chunk, is_last); the last chunk may be shorter, even empty."""
+    buffer = bytearray()
+    async for piece in chunks:
+        buffer += piece
+        while len(buffer) > size:
+            yield bytes(buffer[:size]), False
+            del buffer[:size]
+    yield bytes(buffer), True
+
+
+def _committed_offset(headers) -> int:
+    """Bytes Drive holds for a resumable session, from a 308's Range header."""
+    committed = headers.get("Range")
+    if not committed:
+        return 0
+    return int(committed.rsplit("-", 1)[1]) + 1
+
+
+class _SingleFlight:
+    """Concurrent calls with the same key share one in-flight task."""
+
+    def __init__(self):
+        self._tasks: dict[tuple, asyncio.Future] = {}
+
+    async def do(self, key: tuple, func):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            logger.info("%s: жду уже идущий запрос %s", key[0], key[1])
+        # A cancelled waiter must not cancel the request others are waiting on
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple, task: asyncio.Future):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter left
 
 
 class DriveService:
-    def __init__(self, credentials_path: str):
-        self._credentials_path = credentials_path
-        self.service = self._build_service()
-        self._local = threading.local()
+    def __init__(
+        self,
+        credentials_path: str,
+        *,
+        poll_interval: float = 10,
+        max_staleness: float = 60,
+        memory_cache_max_bytes: int = 200 * 1024 * 1024,
+        disk_cache: DiskContentCache | None = None,
+        page_size: int = 1000,
+        metadata_qps: float = 10,
+        media_qps: float = 10,
+        rate_burst: int = 20,
+        stats_interval: float = 600,
+    ):
+        with open(credentials_path, encoding="utf-8") as f:
+            info = json.load(f)
+        self._signer = crypt.RSASigner.from_service_account_info(info)
+        self._client_email = info["client_email"]
+        self._token_uri = info.get("token_uri", TOKEN_URI)
+
+        self._session: aiohttp.ClientSession | None = None
+        self._token: str | None = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self.retry_metrics = RetryMetrics()
+
+        # Client-side quota shared by all users: separate budgets for
+        # metadata calls and media transfers
+        self._metadata_bucket = TokenBucket(metadata_qps, rate_burst)
+        self._media_bucket = TokenBucket(media_qps, rate_burst)
 
         # Cache: {folder_id: list[dict]}
         self._folder_list_cache: dict[str, list] = {}
         self._file_list_cache: dict[str, list] = {}
 
-        # File content cache: {file_id: {"content": bytes, "filename": str}}
-        self._file_content_cache: dict[str, dict] = {}
+        # File content cache, byte-budgeted LRU:
+        # {file_id: {"content": bytes, "filename": str, "md5": str | None}}
+        self._file_content_cache = MemoryContentCache(memory_cache_max_bytes)
+
+        # Persistent content cache keyed by md5Checksum, checked before media fetch
+        self._disk_cache = disk_cache
 
-        # Mapping file_id -> folder_id (populated by list_files)
+        # Mapping file_id -> folder_id and file_id -> listing entry
+        # (populated page by page by list_files)
         self._file_to_folder: dict[str, str] = {}
+        self._file_meta: dict[str, dict] = {}
 
-        # Changes API token — tracks any change on the drive
-        self._changes_token: str = self._get_start_page_token()
+        # Mapping folder_id -> parent_id (populated by list_folders)
+        self._folder_to_parent: dict[str, str] = {}
+
+        # files.list page size for all listings
+        self._page_size = page_size
+
+        # Concurrent cache misses for one key share a single Drive request
+        self._inflight = _SingleFlight()
 
-    def _build_service(self):
-        creds = service_account.Credentials.from_service_account_file(
-            self._credentials_path, scopes=SCOPES
+        # Changes API token — tracks any change on the drive
+        self._changes_token: str | None = None
+        self._changes_lock = asyncio.Lock()
+
+        # Background watcher keeps caches fresh; reads only hit the change
+        # feed themselves if the last sync is older than max_staleness
+        self._poll_interval = poll_interval
+        self._max_staleness = max_staleness
+        self._last_sync = 0.0
+        self._watcher: asyncio.Task | None = None
+
+        # The watcher also logs cache and retry statistics this often
+        self._stats_interval = stats_interval
+        self._last_stats = time.monotonic()
+
+    async def start(self):
+        """Launch the change watcher. No Drive request happens here, so the
+        bot starts polling Telegram right away."""
+        self._watcher = asyncio.create_task(self._watch_changes())
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._watcher
+            self._watcher = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    # ── HTTP ──
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+                timeout=HTTP_TIMEOUT,
+            )
+        return self._session
+
+    async def _get_access_token(self) -> str:
+        """Service account JWT-bearer flow, token cached until expiry."""
+        async with self._token_lock:
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+
+            started = time.perf_counter()
+            now = int(time.time())
+            assertion = jwt.encode(self._signer, {
+                "iss": self._client_email,
+                "scope": " ".join(SCOPES),
+                "aud": self._token_uri,
+                "iat": now,
+                "exp": now + TOKEN_LIFETIME,
+            })
+            async with self._get_session().post(
+                self._token_uri,
+                data={"grant_type": JWT_GRANT_TYPE, "assertion": assertion.decode()},
+            ) as resp:
+                await _raise_for_status(resp)
+                payload = await resp.json()
+
+            self._token = payload["access_token"]
+            expires_in = payload.get("expires_in", TOKEN_LIFETIME)
+            self._token_expires_at = time.monotonic() + expires_in - TOKEN_REFRESH_MARGIN
+            logger.info("Токен доступа получен за %.0f мс",
+                        (time.perf_counter() - started) * 1000)
+            return self._token
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: dict | None = None,
+        json_body: dict | None = None,
+        data: bytes | None = None,
+        headers: dict | None = None,
+        raw: bool = False,
+        media: bool = False,
+        priority: int = INTERACTIVE,
+    ):
+        """Authorized, rate-limited request with retries. Returns parsed
+        JSON or raw bytes. Media transfers draw from their own quota.
+        POST creates a resource and is retried only when that is safe."""
+        bucket = self._media_bucket if media else self._metadata_bucket
+
+        async def _do():
+            await bucket.acquire(priority)
+            token = await self._get_access_token()
+            req_headers = {"Authorization": f"Bearer {token}", **(headers or {})}
+            async with self._get_session().request(
+                method, url, params=params, json=json_body, data=data,
+                headers=req_headers,
+            ) as resp:
+                await _raise_for_status(resp)
+                if raw:
+                    return await resp.read()
+                return await resp.json(content_type=None)
+
+        classify = _create_error_class if method == "POST" else _error_class
+        return await retry(
+            _do, classify=classify, policies=RETRY_POLICIES,
+            metrics=self.retry_metrics,
         )
-        return build("drive", "v3", credentials=creds)
-
-    def _get_thread_service(self):
-        if not hasattr(self._local, "service"):
-            self._local.service = self._build_service()
-        return self._local.service
-
-    def _get_start_page_token(self) -> str:
-        result = _with_retry(
-            self.service.changes()
-            .getStartPageToken(supportsAllDrives=True)
-            .execute
+
+    # ── Changes ──
+
+    async def _get_start_page_token(self, priority: int) -> str:
+        result = await self._request(
+            "GET", f"{API_URL}/changes/startPageToken",
+            params={"supportsAllDrives": "true"},
+            priority=priority,
         )
         return result["startPageToken"]
 
-    def _check_for_changes(self):
-        """One lightweight API call: are there any changes since last check?
-        If yes — drop all caches."""
-        response = _with_retry(
-            self.service.changes()
-            .list(
-                pageToken=self._changes_token,
-                fields="nextPageToken,newStartPageToken,changes(fileId)",
-                pageSize=1,
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-            )
-            .execute
+    async def _list_changes(self, page_token: str, priority: int) -> dict:
+        return await self._request(
+            "GET", f"{API_URL}/changes",
+            params={
+                "pageToken": page_token,
+                "fields": CHANGES_FIELDS,
+                "pageSize": CHANGES_PAGE_SIZE,
+                "supportsAllDrives": "true",
+                "includeItemsFromAllDrives": "true",
+            },
+            priority=priority,
         )
 
-        if not response.get("changes"):
-            # No changes — caches are valid
+    async def _check_for_changes(self, priority: int = INTERACTIVE):
+        """Read the change feed since the last check and apply every change
+        to the caches. Unaffected entries stay warm."""
+        async with self._changes_lock:
+            started = time.monotonic()
+            if self._changes_token is None:
+                self._changes_token = await self._get_start_page_token(priority)
+                self._last_sync = started
+                return
+
+            response = await self._list_changes(self._changes_token, priority)
+            changes = response.get("changes", [])
+            while "nextPageToken" in response:
+                response = await self._list_changes(response["nextPageToken"], priority)
+                changes.extend(response.get("changes", []))
+
+            if changes:
+                logger.info("Обнаружено изменений на диске: %d", len(changes))
+            for change in changes:
+                self._apply_change(change)
+
+            self._changes_token = response["newStartPageToken"]
+            self._last_sync = started
+
+    async def _watch_changes(self):
+        # The first pass runs immediately: it fetches the start page token and
+        # warms up the access token and connection pool off the startup path
+        while True:
+            try:
+                await self._check_for_changes(priority=BULK)
+            except Exception:
+                logger.exception("Не удалось прочитать ленту изменений")
+            if time.monotonic() - self._last_stats >= self._stats_interval:
+                self._log_stats()
+            await asyncio.sleep(self._poll_interval)
+
+    def _log_stats(self):
+        self._last_stats = time.monotonic()
+        logger.info("Кеш содержимого: %s", self._file_content_cache.stats())
+        logger.info("Повторы запросов к Drive: %s", self.retry_metrics.snapshot())
+
+    async def _ensure_fresh(self):
+        """Sync inline only if the watcher fell behind the staleness bound."""
+        if time.monotonic() - self._last_sync > self._max_staleness:
+            logger.info("Кеш старше %ds, синхронизация с Drive", self._max_staleness)
+            await self._check_for_changes()
+
+    def _apply_change(self, change: dict):
+        """Drop only the listings and content touched by one change."""
+        file_id = change["fileId"]
+        file = change.get("file") or {}
+        gone = change.get("removed", False) or file.get("trashed", False)
+        new_parents = [] if gone else file.get("parents", [])
+
+        if file.get("mimeType") == FOLDER_MIME or file_id in self._folder_to_parent:
+            # Folder renamed / moved / trashed — its parent listings are stale
+            old_parent = self._folder_to_parent.pop(file_id, None)
+            for parent_id in {old_parent, *new_parents} - {None}:
+                self._folder_list_cache.pop(parent_id, None)
+            if gone:
+                self._folder_list_cache.pop(file_id, None)
+                self._file_list_cache.pop(file_id, None)
             return
 
-        logger.info("Обнаружены изменения на диске, сброс кеша")
-        self._folder_list_cache.clear()
-        self._file_list_cache.clear()
-        self._file_content_cache.clear()
-        self._file_to_folder.clear()
-
-        # Drain remaining changes to get the latest token
-        while "nextPageToken" in response:
-            response = _with_retry(
-                self.service.changes()
-                .list(
-                    pageToken=response["nextPageToken"],
-                    fields="nextPageToken,newStartPageToken,changes(fileId)",
-                    pageSize=100,
-                    supportsAllDrives=True,
-                    includeItemsFromAllDrives=True,
-                )
-                .execute
-            )
-
-        self._changes_token = response["newStartPageToken"]
+        old_folder = self._file_to_folder.pop(file_id, None)
+        self._file_meta.pop(file_id, None)
+        for folder_id in {old_folder, *new_parents} - {None}:
+            self._file_list_cache.pop(folder_id, None)
 
-    def _invalidate_folder_files(self, folder_id: str):
-        """Remove file content cache for all files that belonged to a folder."""
-        to_remove = [
-            fid for fid, fol in self._file_to_folder.items()
-            if fol == folder_id
-        ]
-        for fid in to_remove:
-            self._file_content_cache.pop(fid, None)
-            self._file_to_folder.pop(fid, None)
+        cached = self._file_content_cache.peek(file_id)
+        if cached and (gone or cached["md5"] is None
+                       or cached["md5"] != file.get("md5Checksum")):
+            self._file_content_cache.pop(file_id)
+
+    def _index_file(self, folder_id: str, file: dict):
+        """Remember listing metadata of a file as soon as its page arrives;
+        drop cached content if the checksum moved."""
+        fid = file["id"]
+        md5 = file.get("md5Checksum")
+        cached = self._file_content_cache.peek(fid)
+        if cached and (md5 is None or cached["md5"] != md5):
+            self._file_content_cache.pop(fid)
+        self._file_to_folder[fid] = folder_id
+        self._file_meta[fid] = file
+
+    def _drop_missing_files(self, folder_id: str, files: list[dict]):
+        """After a complete listing: forget files that left the folder."""
+        current = {f["id"] for f in files}
+        for fid, fol in list(self._file_to_folder.items()):
+            if fol == folder_id and fid not in current:
+                self._file_to_folder.pop(fid, None)
+                self._file_meta.pop(fid, None)
+                self._file_content_cache.pop(fid)
+
+    # ── Public API ──
+
+    async def _iter_pages(self, query: str, fields: str):
+        """files.list pages as they arrive, following every nextPageToken."""
+        params = {
+            "q": query, "fields": f"nextPageToken, {fields}", "orderBy": "name",
+            "pageSize": self._page_size,
+            "supportsAllDrives": "true", "includeItemsFromAllDrives": "true",
+        }
+        while True:
+            results = await self._request("GET", f"{API_URL}/files", params=params)
+            yield results.get("files", [])
+            if "nextPageToken" not in results:
+                return
+            params = {**params, "pageToken": results["nextPageToken"]}
 
-    def list_folders(self, parent_folder_id: str) -> list[dict]:
-        self._check_for_changes()
+    async def list_folders(self, parent_folder_id: str) -> list[dict]:
+        await self._ensure_fresh()
 
         cached = self._folder_list_cache.get(parent_folder_id)
         if cached is not None:
             logger.info("list_folders: cache HIT (%d папок)", len(cached))
             return cached
 
+        return await self._inflight.do(
+            ("list_folders", parent_folder_id),
+            lambda: self._fetch_folders(parent_folder_id),
+        )
+
+    async def iter_folders(self, parent_folder_id: str):
+        """Yield subfolders page by page as they arrive from Drive, so a
+        caller can show the first page before the listing is complete."""
+        await self._ensure_fresh()
+
+        cached = self._folder_list_cache.get(parent_folder_id)
+        if cached is not None:
+            yield cached
+            return
+
+        logger.info("iter_folders: cache MISS, запрос к Drive API")
+        async for page in self._stream_folders(parent_folder_id):
+            yield page
+
+    async def _fetch_folders(self, parent_folder_id: str) -> list[dict]:
         logger.info("list_folders: cache MISS, запрос к Drive API")
+        data = []
+        async for page in self._stream_folders(parent_folder_id):
+            data.extend(page)
+        return data
+
+    async def _stream_folders(self, parent_folder_id: str):
         query = (
             f"'{parent_folder_id}' in parents "
-            "and mimeType = 'application/vnd.google-apps.folder' "
+            f"and mimeType = '{FOLDER_MIME}' "
             "and trashed = false"
         )
-        results = _with_retry(
-            self.service.files()
-            .list(
-                q=query, fields="files(id, name)", orderBy="name",
-                supportsAllDrives=True, includeItemsFromAllDrives=True,
-            )
-            .execute
-        )
-        data = results.get("files", [])
-
+        data = []
+        async for page in self._iter_pages(query, "files(id, name)"):
+            for f in page:
+                self._folder_to_parent[f["id"]] = parent_folder_id
+            data.extend(page)
+            yield page
+
+        # Only a complete listing may be served from cache
         self._folder_list_cache[parent_folder_id] = data
-        return data
 
-    def list_files(self, folder_id: str) -> list[dict]:
-        self._check_for_changes()
+    async def list_files(self, folder_id: str) -> list[dict]:
+        await self._ensure_fresh()
 
         cached = self._file_list_cache.get(folder_id)
         if cached is not None:
@@ -153,144 +564,459 @@ class DriveService:
             return cached
 
         logger.info("list_files: cache MISS, запрос к Drive API")
-
-        # Cache miss — invalidate file content cache for this folder
-        self._invalidate_folder_files(folder_id)
-
+        grouped = await self._inflight.do(
+            ("list_files", folder_id),
+            lambda: self._fetch_files([folder_id]),
+        )
+        return grouped[folder_id]
+
+    async def list_files_many(self, folder_ids: list[str]) -> dict[str, list[dict]]:
+        """Listings of several folders, grouped by folder id in input order.
+        All cache misses are fetched with OR'ed 'in parents' queries."""
+        await self._ensure_fresh()
+
+        grouped = {}
+        missing = []
+        for folder_id in dict.fromkeys(folder_ids):
+            cached = self._file_list_cache.get(folder_id)
+            if cached is not None:
+                grouped[folder_id] = cached
+            else:
+                missing.append(folder_id)
+
+        if missing:
+            logger.info("list_files_many: cache MISS для %d из %d папок",
+                        len(missing), len(grouped) + len(missing))
+            chunks = [
+                tuple(missing[i:i + LIST_MANY_CHUNK])
+                for i in range(0, len(missing), LIST_MANY_CHUNK)
+            ]
+            fetched = await asyncio.gather(*[
+                self._inflight.do(
+                    ("list_files_many", chunk),
+                    lambda chunk=chunk: self._fetch_files(list(chunk)),
+                )
+                for chunk in chunks
+            ])
+            for part in fetched:
+                grouped.update(part)
+        else:
+            logger.info("list_files_many: cache HIT (%d папок)", len(grouped))
+
+        return {folder_id: grouped[folder_id] for folder_id in dict.fromkeys(folder_ids)}
+
+    async def _fetch_files(self, folder_ids: list[str]) -> dict[str, list[dict]]:
+        grouped: dict[str, list[dict]] = {folder_id: [] for folder_id in folder_ids}
+        async for part in self._stream_files(folder_ids):
+            for folder_id, files in part.items():
+                grouped[folder_id].extend(files)
+        return grouped
+
+    async def _stream_files(self, folder_ids: list[str]):
+        """Yield {folder_id: files} per page. Every page is indexed on
+        arrival; complete listings go to the cache after the last page."""
+        parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
         query = (
-            f"'{folder_id}' in parents "
-            "and mimeType != 'application/vnd.google-apps.folder' "
+            f"({parents}) "
+            f"and mimeType != '{FOLDER_MIME}' "
             "and trashed = false"
         )
-        results = _with_retry(
-            self.service.files()
-            .list(
-                q=query, fields="files(id, name, mimeType)", orderBy="name",
-                supportsAllDrives=True, includeItemsFromAllDrives=True,
-            )
-            .execute
-        )
-        data = results.get("files", [])
-
-        self._file_list_cache[folder_id] = data
-
-        # Update file -> folder mapping
-        for f in data:
-            self._file_to_folder[f["id"]] = folder_id
-
-        return data
-
-    def download_file(self, file_id: str) -> tuple[bytes, str]:
-        # No _check_for_changes here — already checked by list_files before download
+        grouped: dict[str, list[dict]] = {folder_id: [] for folder_id in folder_ids}
+        async for page in self._iter_pages(
+            query, "files(id, name, mimeType, md5Checksum, size, createdTime, parents)"
+        ):
+            part: dict[str, list[dict]] = {folder_id: [] for folder_id in folder_ids}
+            for f in page:
+                for parent_id in f.get("parents", []):
+                    if parent_id in part:
+                        part[parent_id].append(f)
+                        self._index_file(parent_id, f)
+            for folder_id, files in part.items():
+                grouped[folder_id].extend(files)
+            yield part
+
+        for folder_id, data in grouped.items():
+            self._file_list_cache[folder_id] = data
+            self._drop_missing_files(folder_id, data)
+
+    def _listed_file(self, file_id: str) -> dict | None:
+        """Listing metadata of a file, available as soon as its page arrived."""
+        return self._file_meta.get(file_id)
+
+    async def download_file(
+        self, file_id: str, *, priority: int = INTERACTIVE,
+    ) -> tuple[bytes, str]:
+        # No _ensure_fresh here — already checked by list_files before download
         cached = self._file_content_cache.get(file_id)
         if cached:
             logger.info("download_file: cache HIT «%s»", cached["filename"])
             return cached["content"], cached["filename"]
 
-        logger.info("download_file: cache MISS, скачиваю %s", file_id)
-        service = self._get_thread_service()
-
-        file_meta = _with_retry(
-            service.files()
-            .get(fileId=file_id, fields="name", supportsAllDrives=True)
-            .execute
+        return await self._inflight.do(
+            ("download_file", file_id),
+            lambda: self._fetch_file(file_id, priority),
         )
+
+    async def _fetch_file(self, file_id: str, priority: int) -> tuple[bytes, str]:
+        # Name and checksum come from the folder listing, so a miss is a
+        # single media request; files.get only for files never listed
+        file_meta = self._listed_file(file_id)
+        if file_meta is None:
+            file_meta = await self._request(
+                "GET", f"{API_URL}/files/{file_id}",
+                params={"fields": "name, md5Checksum", "supportsAllDrives": "true"},
+                priority=priority,
+            )
         filename = file_meta["name"]
+        md5 = file_meta.get("md5Checksum")
 
-        def _do_download():
-            buf = io.BytesIO()
-            req = service.files().get_media(fileId=file_id)
-            dl = MediaIoBaseDownload(buf, req)
-            done = False
-            while not done:
-                _, done = dl.next_chunk()
-            return buf
-
-        buffer = _with_retry(_do_download)
-
-        content = buffer.getvalue()
-        self._file_content_cache[file_id] = {
-            "content": content,
-            "filename": filename,
-        }
+        if md5 and self._disk_cache is not None:
+            content = await asyncio.to_thread(self._disk_cache.get, md5)
+            if content is not None:
+                logger.info("download_file: disk HIT «%s»", filename)
+                self._file_content_cache.put(file_id, content, filename, md5)
+                return content, filename
+
+        logger.info("download_file: cache MISS, скачиваю %s", file_id)
+        content = await self._request(
+            "GET", f"{API_URL}/files/{file_id}",
+            params={"alt": "media", "supportsAllDrives": "true"},
+            raw=True, media=True, priority=priority,
+        )
+
+        # Key by the actual bytes: the listing may predate a concurrent edit
+        md5 = hashlib.md5(content).hexdigest()
+        if self._disk_cache is not None:
+            await asyncio.to_thread(self._disk_cache.put, md5, content)
+
+        self._file_content_cache.put(file_id, content, filename, md5)
         return content, filename
 
-    def create_folder(self, name: str, parent_id: str) -> dict:
+    async def create_folder(self, name: str, parent_id: str) -> dict:
         metadata = {
             "name": name,
-            "mimeType": "application/vnd.google-apps.folder",
+            "mimeType": FOLDER_MIME,
             "parents": [parent_id],
         }
-        folder = _with_retry(
-            self.service.files()
-            .create(body=metadata, fields="id, name", supportsAllDrives=True)
-            .execute
+        folder = await self._request(
+            "POST", f"{API_URL}/files",
+            params={"fields": "id, name", "supportsAllDrives": "true"},
+            json_body=metadata,
         )
 
-        # Invalidate + advance token so next _check_for_changes won't re-clear
         self._folder_list_cache.pop(parent_id, None)
-        self._changes_token = self._get_start_page_token()
         logger.info("create_folder: «%s» создана, кеш папок сброшен", name)
 
         return {"id": folder["id"], "name": folder["name"]}
 
-    def upload_file(
+    async def upload_file(
         self, file_content: bytes, filename: str, folder_id: str
     ) -> dict:
         metadata = {"name": filename, "parents": [folder_id]}
-        media = MediaIoBaseUpload(
-            io.BytesIO(file_content), mimetype="application/octet-stream"
+        body, content_type = _multipart_body(
+            metadata, file_content, "application/octet-stream"
         )
-        result = _with_retry(
-            self.service.files()
-            .create(
-                body=metadata, media_body=media, fields="id, name",
-                supportsAllDrives=True,
-            )
-            .execute
+        result = await self._request(
+            "POST", f"{UPLOAD_URL}/files",
+            params={
+                "uploadType": "multipart", "fields": "id, name",
+                "supportsAllDrives": "true",
+            },
+            data=body,
+            headers={"Content-Type": content_type},
+            media=True,
         )
 
-        # Invalidate + advance token so next _check_for_changes won't re-clear
         self._file_list_cache.pop(folder_id, None)
-        self._invalidate_folder_files(folder_id)
-        self._changes_token = self._get_start_page_token()
         logger.info("upload_file: «%s» загружен, кеш файлов сброшен", filename)
 
         return {"id": result["id"], "name": result["name"]}
 
-    def update_file(
-        self, file_id: str, file_content: bytes, mime_type: str
+    async def upload_stream(
+        self,
+        chunks,
+        filename: str,
+        folder_id: str,
+        mime_type: str = "application/octet-stream",
+    ) -> dict:
+        """Resumable upload from an async iterator of bytes.
+
+        The stream is sent in UPLOAD_CHUNK_SIZE chunks as it arrives, so the
+        file is never held in memory whole. A chunk that fails is resumed
+        from the offset Drive has committed, not from the start."""
+        result = await self._upload_stream(chunks, filename, folder_id, mime_type, INTERACTIVE)
+        self._file_list_cache.pop(folder_id, None)
+        logger.info("upload_stream: кеш файлов папки %s сброшен", folder_id)
+        return result
+
+    async def upload_many(
+        self, uploads: list[tuple[str, object]], folder_id: str, *, concurrency: int = 4
+    ) -> list[dict | Exception]:
+        """Upload (filename, chunks) streams into one folder, at most
+        `concurrency` at a time. Returns file metadata or the raised
+        exception per upload, in input order. Runs at bulk priority; the
+        folder listing is invalidated once for the whole batch."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _one(filename: str, chunks):
+            async with semaphore:
+                try:
+                    return await self._upload_stream(
+                        chunks, filename, folder_id, "application/octet-stream", BULK
+                    )
+                except Exception as e:
+                    return e
+
+        try:
+            return await asyncio.gather(*(_one(name, chunks) for name, chunks in uploads))
+        finally:
+            self._file_list_cache.pop(folder_id, None)
+            logger.info(
+                "upload_many: %d файлов, кеш файлов папки %s сброшен", len(uploads), folder_id
+            )
+
+    async def _upload_stream(
+        self, chunks, filename: str, folder_id: str, mime_type: str, priority: int
     ) -> dict:
-        media = MediaIoBaseUpload(
-            io.BytesIO(file_content), mimetype=mime_type
+        session_url = await self._start_resumable_upload(
+            filename, folder_id, mime_type, priority
         )
-        result = _with_retry(
-            self.service.files()
-            .update(
-                fileId=file_id, media_body=media, fields="id, name",
-                supportsAllDrives=True,
+        offset = 0
+        result = None
+        async for chunk, last in _fixed_chunks(chunks, UPLOAD_CHUNK_SIZE):
+            total = offset + len(chunk) if last else None
+            result = await self._upload_chunk(session_url, chunk, offset, total, priority)
+            offset += len(chunk)
+
+        logger.info("upload: «%s» загружен (%d байт)", filename, offset)
+        return {"id": result["id"], "name": result["name"]}
+
+    async def _upload_call(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: dict,
+        params: dict | None = None,
+        json_body: dict | None = None,
+        data: bytes | None = None,
+        priority: int = INTERACTIVE,
+    ):
+        """One resumable-upload request without retries. Returns (status,
+        headers, JSON); 308 Resume Incomplete is a result, not an error."""
+        await self._media_bucket.acquire(priority)
+        token = await self._get_access_token()
+        async with self._get_session().request(
+            method, url, params=params, json=json_body, data=data,
+            headers={"Authorization": f"Bearer {token}", **headers},
+            allow_redirects=False,
+        ) as resp:
+            await _raise_for_status(resp)
+            payload = None if resp.status == 308 else await resp.json(content_type=None)
+            return resp.status, resp.headers, payload
+
+    async def _start_resumable_upload(
+        self, filename: str, folder_id: str, mime_type: str, priority: int
+    ) -> str:
+        async def _do():
+            _, headers, _ = await self._upload_call(
+                "POST", f"{UPLOAD_URL}/files",
+                params={
+                    "uploadType": "resumable", "fields": "id, name",
+                    "supportsAllDrives": "true",
+                },
+                json_body={"name": filename, "parents": [folder_id]},
+                headers={"X-Upload-Content-Type": mime_type},
+                priority=priority,
             )
-            .execute
+            return headers["Location"]
+
+        return await retry(
+            _do, classify=_create_error_class, policies=RETRY_POLICIES,
+            metrics=self.retry_metrics,
         )
 
-        # Invalidate caches + advance token
-        folder_id = self._file_to_folder.get(file_id)
-        if folder_id:
-            self._file_list_cache.pop(folder_id, None)
-            self._invalidate_folder_files(folder_id)
-        self._file_content_cache.pop(file_id, None)
-        self._changes_token = self._get_start_page_token()
+    async def _upload_chunk(
+        self,
+        session_url: str,
+        chunk: bytes,
+        start: int,
+        total: int | None,
+        priority: int,
+    ) -> dict | None:
+        """Send chunk at offset start; total is known only for the last one.
+        Returns the file metadata once Drive has the whole file."""
+        size = "*" if total is None else str(total)
+        end = start + len(chunk)
+        committed = start
+        failed = False
+
+        async def _do():
+            nonlocal committed, failed
+            if failed:
+                # Ask how much of the chunk arrived before the failure
+                status, headers, payload = await self._upload_call(
+                    "PUT", session_url, headers={"Content-Range": f"bytes */{size}"},
+                    priority=priority,
+                )
+                if status != 308:
+                    return payload
+                committed = _committed_offset(headers)
+            failed = True
+
+            while True:
+                body = chunk[committed - start:]
+                content_range = (
+                    f"bytes {committed}-{end - 1}/{size}" if body else f"bytes */{size}"
+                )
+                status, headers, payload = await self._upload_call(
+                    "PUT", session_url, data=body,
+                    headers={"Content-Range": content_range},
+                    priority=priority,
+                )
+                if status != 308:
+                    return payload
+                # Drive may keep only part of what was sent
+                committed = _committed_offset(headers)
+                if committed >= end:
+                    failed = False
+                    return None
+
+        return await retry(
+            _do, classify=_error_class, policies=RETRY_POLICIES,
+            metrics=self.retry_metrics,
+        )
+
+    async def update_file(
+        self,
+        file_id: str,
+        file_content: bytes,
+        mime_type: str,
+        *,
+        base_revision: str | None = None,
+    ) -> dict:
+        """Replace the file's content. With base_revision, the write is
+        checked afterwards: RevisionConflict if the revision before ours is
+        not base_revision (Drive v3 has no precondition on updates)."""
+        result = await self._request(
+            "PATCH", f"{UPLOAD_URL}/files/{file_id}",
+            params={
+                "uploadType": "media",
+                "fields": "id, name, md5Checksum, headRevisionId",
+                "supportsAllDrives": "true",
+            },
+            data=file_content,
+            headers={"Content-Type": mime_type},
+            media=True,
+        )
+
+        # Content and new checksum are known — write them through, and
+        # patch the listing entry instead of re-listing the folder
+        md5 = result.get("md5Checksum")
+        listed = self._file_meta.get(file_id)
+        if listed is not None:
+            listed["md5Checksum"] = md5
+            listed["size"] = str(len(file_content))
+        self._file_content_cache.put(file_id, file_content, result["name"], md5)
+        if md5 and self._disk_cache is not None:
+            await asyncio.to_thread(self._disk_cache.put, md5, file_content)
         logger.info("update_file: «%s» обновлён", result["name"])
 
-        return {"id": result["id"], "name": result["name"]}
+        revision_id = result.get("headRevisionId")
+        if base_revision is not None:
+            previous_id = await self._previous_revision(file_id, revision_id)
+            if previous_id != base_revision:
+                raise RevisionConflict(file_id, revision_id, previous_id)
+
+        return {
+            "id": result["id"], "name": result["name"], "md5Checksum": md5,
+            "headRevisionId": revision_id,
+        }
 
-    def find_file_by_name(self, folder_id: str, filename: str) -> dict | None:
-        files = self.list_files(folder_id)
-        for f in files:
-            if f["name"] == filename:
-                return f
+    async def get_head_revision(self, file_id: str) -> dict:
+        """Current md5Checksum and headRevisionId, bypassing the caches."""
+        return await self._request(
+            "GET", f"{API_URL}/files/{file_id}",
+            params={
+                "fields": "id, md5Checksum, headRevisionId",
+                "supportsAllDrives": "true",
+            },
+        )
+
+    async def _previous_revision(self, file_id: str, revision_id: str) -> str | None:
+        """The revision right before revision_id; None if there is none or
+        revision_id is still missing from the list."""
+        for attempt in range(REVISION_LIST_ATTEMPTS):
+            revisions = await self.list_revisions(file_id)
+            if revision_id in revisions:
+                position = revisions.index(revision_id)
+                return revisions[position - 1] if position > 0 else None
+            await asyncio.sleep(REVISION_LIST_DELAY * 2 ** attempt)
+
+        # Still not listed: guessing could name a revision older than the
+        # base and hide an overwritten one, so the caller starts over
+        logger.warning(
+            "update_file: ревизии %s всё ещё нет в списке файла %s",
+            revision_id, file_id,
+        )
         return None
 
+    async def list_revisions(self, file_id: str) -> list[str]:
+        """Revision ids of a file, oldest first."""
+        revision_ids = []
+        params = {"fields": "nextPageToken, revisions(id)", "pageSize": 1000}
+        while True:
+            result = await self._request(
+                "GET", f"{API_URL}/files/{file_id}/revisions", params=params,
+            )
+            revision_ids.extend(r["id"] for r in result.get("revisions", []))
+            if "nextPageToken" not in result:
+                return revision_ids
+            params = {**params, "pageToken": result["nextPageToken"]}
+
+    async def download_revision(self, file_id: str, revision_id: str) -> bytes:
+        """Content of one revision; never cached, revisions are exact."""
+        return await self._request(
+            "GET", f"{API_URL}/files/{file_id}/revisions/{revision_id}",
+            params={"alt": "media"},
+            raw=True, media=True,
+        )
+
+    async def find_file_by_name(self, folder_id: str, filename: str) -> dict | None:
+        """The oldest file with this name, so that every instance picks the
+        same one if a name is taken twice."""
+        files = await self.list_files(folder_id)
+        matches = [f for f in files if f["name"] == filename]
+        if not matches:
+            return None
+        return min(matches, key=lambda f: (f.get("createdTime", ""), f["id"]))
+
+    async def list_files_by_name(self, folder_id: str, filename: str) -> list[dict]:
+        """Every file with this name in the folder, oldest first, straight
+        from Drive (the cached listing may not have a fresh copy yet)."""
+        name = filename.replace("\\", "\\\\").replace("'", "\\'")
+        query = (
+            f"'{folder_id}' in parents and name = '{name}' "
+            f"and mimeType != '{FOLDER_MIME}' and trashed = false"
+        )
+        files = []
+        async for page in self._iter_pages(query, "files(id, name, md5Checksum, createdTime)"):
+            files.extend(page)
+        return sorted(files, key=lambda f: (f.get("createdTime", ""), f["id"]))
+
+    async def trash_file(self, file_id: str, folder_id: str) -> None:
+        """Move a file to the trash (it can be restored from there)."""
+        await self._request(
+            "PATCH", f"{API_URL}/files/{file_id}",
+            params={"fields": "id", "supportsAllDrives": "true"},
+            json_body={"trashed": True},
+        )
+        self._file_list_cache.pop(folder_id, None)
+        self._file_to_folder.pop(file_id, None)
+        self._file_meta.pop(file_id, None)
+        self._file_content_cache.pop(file_id)
+        logger.info("trash_file: %s в корзине, кеш файлов сброшен", file_id)
+
     @staticmethod
     def get_folder_link(folder_id: str) -> str:
         return f"https://drive.google.com/drive/folders/{folder_id}"
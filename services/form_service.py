@@ -1,11 +1,15 @@
+import asyncio
+import contextlib
 import csv
 import io
+import json
 import logging
-import threading
-from dataclasses import dataclass, fields
+import random
+import uuid
+from dataclasses import dataclass, fields, replace
 from datetime import datetime, timezone
 
-from services.drive_service import DriveService
+from services.drive_service import DriveApiError, DriveService, RevisionConflict
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +21,22 @@ CSV_FIELDS = [
 ]
 BOM = "\ufeff"
 
+# Mutations since the last compaction, one JSON object per line
+JOURNAL_FILENAME = "формы.journal.jsonl"
+JOURNAL_MIME = "text/plain"
+
+# FormService storage modes: one file in the root folder, or one per folder
+STORAGE_MODES = ("single", "sharded")
+# Storage files, to be left out of folder contents shown to users
+FORM_FILENAMES = {CSV_FILENAME, JOURNAL_FILENAME}
+
+# Random pause before rewriting after a RevisionConflict, seconds, so two
+# instances merging at once don't keep overwriting each other
+MERGE_JITTER = 0.5
+# Writes per flush or compaction before a storage file conflict is given up;
+# what was overwritten is still merged by the next write of that file
+MAX_MERGE_ATTEMPTS = 5
+
 
 @dataclass
 class Form:
@@ -31,68 +51,748 @@ class Form:
     pinned: bool = False
 
 
-class FormService:
-    def __init__(self, drive: DriveService, root_folder_id: str):
+class _FormIndex:
+    """формы.csv with its journal replayed on top, indexed by folder."""
+
+    def __init__(
+        self,
+        rows: list[Form],
+        csv_md5: str | None,
+        journal: list[dict] | None = None,
+        journal_md5: str | None = None,
+    ):
+        self.rows: list[Form] = []
+        self.by_id: dict[str, list[Form]] = {}
+        self.by_name: dict[str, list[Form]] = {}
+        self.csv_md5 = csv_md5
+        self.journal_md5 = journal_md5
+        self.journal = list(journal or [])
+        for r in rows:
+            self._add(r)
+        for entry in self.journal:
+            self.apply(entry)
+
+    def _add(self, r: Form):
+        self.rows.append(r)
+        self.by_id.setdefault(r.folder_id, []).append(r)
+        self.by_name.setdefault(r.folder_name, []).append(r)
+
+    def _remove(self, r: Form):
+        self.rows.remove(r)
+        for index, key in ((self.by_id, r.folder_id), (self.by_name, r.folder_name)):
+            index[key].remove(r)
+            if not index[key]:
+                del index[key]
+
+    def find(self, folder_id: str, folder_name: str) -> list[Form]:
+        return self.by_id.get(folder_id) or self.by_name.get(folder_name, [])
+
+    def get(self, folder_id: str, version: int) -> Form | None:
+        for r in self.by_id.get(folder_id, []):
+            if r.version == version:
+                return r
+        return None
+
+    def _target(self, entry: dict) -> Form | None:
+        """Row an edit, pin or delete refers to. Entries name it by its
+        creation time, which survives renumbering of a concurrent create;
+        older entries only carry the version."""
+        created_at = entry.get("created_at")
+        if created_at is None:
+            return self.get(entry["folder_id"], entry["version"])
+        matches = [
+            r for r in self.by_id.get(entry["folder_id"], []) if r.created_at == created_at
+        ]
+        # Rows made by hand may share a timestamp; then the version decides
+        for r in matches:
+            if r.version == entry["version"]:
+                return r
+        return matches[0] if matches else None
+
+    def apply(self, entry: dict):
+        """Apply one journal entry. Entries carry absolute values, and a
+        create is recognised by its timestamp, so replaying entries already
+        folded into the CSV changes nothing."""
+        op = entry["op"]
+        folder_id = entry["folder_id"]
+        version = entry["version"]
+
+        if op == "create":
+            folder_rows = self.by_id.get(folder_id, [])
+            if any(r.created_at == entry["at"] for r in folder_rows):
+                return  # already folded into the CSV
+            for r in self.find(folder_id, entry["folder_name"]):
+                r.pinned = False
+            if self.get(folder_id, version) is not None:
+                # Another instance created the same version concurrently;
+                # every instance replays the journal in the same order
+                version = max(r.version for r in folder_rows) + 1
+            self._add(Form(
+                folder_id=folder_id,
+                folder_name=entry["folder_name"],
+                version=version,
+                content=entry["content"],
+                author=entry["author"],
+                created_at=entry["at"],
+                updated_at=entry["at"],
+                note=entry["note"],
+            ))
+        elif op == "edit":
+            r = self._target(entry)
+            if r is not None:
+                r.content = entry["content"]
+                r.note = entry["note"]
+                r.author = entry["author"]
+                r.updated_at = entry["at"]
+        elif op == "delete":
+            r = self._target(entry)
+            if r is not None:
+                self._remove(r)
+        elif op == "pin":
+            r = self._target(entry)
+            if r is not None:
+                if entry["pinned"]:
+                    for other in self.by_id[folder_id]:
+                        other.pinned = False
+                r.pinned = entry["pinned"]
+        else:
+            logger.warning("Журнал форм: неизвестная операция %r", op)
+
+
+def _parse_csv(text: str) -> list[Form]:
+    if not text.strip():
+        return []
+
+    reader = csv.DictReader(io.StringIO(text))
+    rows = []
+    for row in reader:
+        rows.append(Form(
+            folder_id=row["folder_id"],
+            folder_name=row["folder_name"],
+            version=int(row["version"]),
+            content=row["content"],
+            author=row["author"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+            note=row.get("note", ""),
+            pinned=row.get("pinned", "").lower() == "true",
+        ))
+    return rows
+
+
+def _encode_csv(rows: list[Form]) -> bytes:
+    buf = io.StringIO()
+    buf.write(BOM)
+    writer = csv.DictWriter(
+        buf, fieldnames=CSV_FIELDS, quoting=csv.QUOTE_ALL,
+    )
+    writer.writeheader()
+    for r in rows:
+        row_dict = {f.name: getattr(r, f.name) for f in fields(r)}
+        row_dict["pinned"] = "true" if r.pinned else "false"
+        writer.writerow(row_dict)
+    return buf.getvalue().encode("utf-8")
+
+
+def _union_rows(rows: list[Form], extra: list[Form]) -> list[Form]:
+    """rows plus the rows of extra they lack. A row is matched by folder
+    and creation time, as journal replay does; a version already taken in
+    the folder is renumbered."""
+    result = list(rows)
+    seen = {(r.folder_id, r.created_at) for r in rows}
+    for r in extra:
+        if (r.folder_id, r.created_at) in seen:
+            continue
+        taken = {x.version for x in result if x.folder_id == r.folder_id}
+        version = max(taken) + 1 if r.version in taken else r.version
+        result.append(replace(r, version=version))
+        seen.add((r.folder_id, r.created_at))
+    return result
+
+
+def _encode_journal(journal: list[dict]) -> bytes:
+    return "".join(
+        json.dumps(entry, ensure_ascii=False) + "\n" for entry in journal
+    ).encode("utf-8")
+
+
+def _parse_journal(text: str) -> list[dict]:
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            logger.warning("Журнал форм: пропущена повреждённая строка")
+    return entries
+
+
+class _FormStore:
+    """Forms kept in формы.csv inside one Drive folder.
+
+    Mutations are appended to a small journal file next to the CSV instead
+    of rewriting it; compact() folds the journal into the CSV, and
+    compact_needed is set once the journal reaches journal_max_entries.
+
+    Journal writes are deferred: a mutation is visible to readers at once,
+    and everything changed within write_delay seconds goes to Drive in one
+    update. close() writes what is still pending.
+
+    Several bot instances may share the files. There is no cross-process
+    lock: every write names the revision it was based on, and if another
+    instance wrote in between, its revision is merged in and the write
+    repeated (see _merge_journal). Files created by two instances at once
+    are merged into the oldest copy (see _create_file)."""
+
+    def __init__(
+        self,
+        drive: DriveService,
+        folder_id: str,
+        *,
+        journal_max_entries: int,
+        write_delay: float,
+        compact_needed: asyncio.Event,
+        create_missing: bool,
+    ):
         self._drive = drive
-        self._root_folder_id = root_folder_id
-        self._lock = threading.Lock()
+        self._folder_id = folder_id
+        # _lock guards the index and pending entries; it is never held
+        # across a Drive write. _write_lock serialises this instance's
+        # journal and CSV writes (flush and compaction)
+        self._lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        # Parsed CSV + journal, reused while both checksums are unchanged
+        self._index: _FormIndex | None = None
+
+        self._journal_max_entries = journal_max_entries
+        self._compact_needed = compact_needed
+        # Shards get their CSV on first compaction; the single root file
+        # is created by hand
+        self._create_missing = create_missing
 
-    def _get_csv_file_id(self) -> str | None:
-        file_info = self._drive.find_file_by_name(self._root_folder_id, CSV_FILENAME)
-        return file_info["id"] if file_info else None
+        # Journal entries applied to the index but not yet written to Drive
+        self._write_delay = write_delay
+        self._pending: list[dict] = []
+        self._flusher: asyncio.Task | None = None
 
-    def _load_csv(self) -> list[Form]:
-        file_info = self._drive.find_file_by_name(self._root_folder_id, CSV_FILENAME)
+        # {file_id: revisions our writes overwrote}, merged into every write
+        # of that file until one lands cleanly — even across failed flushes
+        self._overwritten: dict[str, list[str]] = {}
+        # {file_id: [(base, revision)]} for our conflicting writes the
+        # revision list didn't show yet: what they replaced is still unknown
+        self._unlisted: dict[str, list[tuple[str, str]]] = {}
+
+    @property
+    def has_journal(self) -> bool:
+        """Whether compact() has anything to fold, as far as this instance
+        knows (an unloaded store might)."""
+        return self._index is None or bool(self._index.journal) or bool(self._pending)
+
+    async def close(self):
+        """Stop the deferred writer and write pending edits."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+        await self.flush()
+
+    async def _find_file(self, filename: str) -> dict | None:
+        return await self._drive.find_file_by_name(self._folder_id, filename)
+
+    async def _read_text(self, file_info: dict | None) -> str:
         if not file_info:
-            return []
-
-        content_bytes, _ = self._drive.download_file(file_info["id"])
-        text = content_bytes.decode("utf-8-sig")
-        if not text.strip():
-            return []
-
-        reader = csv.DictReader(io.StringIO(text))
-        rows = []
-        for row in reader:
-            rows.append(Form(
-                folder_id=row["folder_id"],
-                folder_name=row["folder_name"],
-                version=int(row["version"]),
-                content=row["content"],
-                author=row["author"],
-                created_at=row["created_at"],
-                updated_at=row["updated_at"],
-                note=row.get("note", ""),
-                pinned=row.get("pinned", "").lower() == "true",
-            ))
-        return rows
+            return ""
+        content_bytes, _ = await self._drive.download_file(file_info["id"])
+        return content_bytes.decode("utf-8-sig")
+
+    async def _load_index(self) -> _FormIndex:
+        """Current index; downloads and parses only when a listed checksum
+        differs from the ones the index was built from."""
+        csv_file = await self._find_file(CSV_FILENAME)
+        journal_file = await self._find_file(JOURNAL_FILENAME)
+        csv_md5 = csv_file.get("md5Checksum") if csv_file else None
+        journal_md5 = journal_file.get("md5Checksum") if journal_file else None
+
+        index = self._index
+        # A listed file without a checksum can't be compared — always reload
+        comparable = (csv_md5 or not csv_file) and (journal_md5 or not journal_file)
+        if (
+            index is not None and comparable
+            and (csv_md5, journal_md5) == (index.csv_md5, index.journal_md5)
+        ):
+            return index
 
-    def _save_csv(self, rows: list[Form]) -> None:
-        buf = io.StringIO()
-        buf.write(BOM)
-        writer = csv.DictWriter(
-            buf, fieldnames=CSV_FIELDS, quoting=csv.QUOTE_ALL,
+        rows = _parse_csv(await self._read_text(csv_file))
+        journal = _parse_journal(await self._read_text(journal_file))
+        # Edits not flushed yet stay visible on top of whatever Drive has;
+        # an entry that did reach Drive is recognised by its id
+        persisted = {entry.get("id") for entry in journal}
+        journal += [entry for entry in self._pending if entry["id"] not in persisted]
+        logger.info(
+            "Формы: прочитано %d записей, в журнале %d", len(rows), len(journal)
         )
-        writer.writeheader()
-        for r in rows:
-            row_dict = {f.name: getattr(r, f.name) for f in fields(r)}
-            row_dict["pinned"] = "true" if r.pinned else "false"
-            writer.writerow(row_dict)
+        self._index = _FormIndex(rows, csv_md5, journal, journal_md5)
+        return self._index
+
+    def _append(self, index: _FormIndex, op: str, **values) -> None:
+        """Apply a mutation to the index and queue it as a journal entry."""
+        entry = {
+            "id": uuid.uuid4().hex,
+            "op": op,
+            "at": datetime.now(timezone.utc).isoformat(),
+            **values,
+        }
+        index.apply(entry)
+        index.journal.append(entry)
+        self._pending.append(entry)
+        if self._write_delay > 0 and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_later())
+        if len(index.journal) >= self._journal_max_entries:
+            self._compact_needed.set()
+
+    async def _write_through(self) -> None:
+        """Without a write delay, a mutation is on Drive before it returns."""
+        if self._write_delay <= 0:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write pending journal entries to Drive now. Reads and new edits
+        go on while the journal is being written; entries queued meanwhile
+        wait for the next flush."""
+        async with self._write_lock:
+            async with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return
+            journal_md5, journal = await self._merge_journal(batch, set())
+            logger.info("Формы: сохранено изменений: %d", len(batch))
+
+            async with self._lock:
+                flushed = {entry["id"] for entry in batch}
+                self._pending = [e for e in self._pending if e["id"] not in flushed]
+                index = self._index
+                written = [e["id"] for e in journal] + [e["id"] for e in self._pending]
+                if (
+                    index is not None and journal_md5
+                    and written == [e["id"] for e in index.journal]
+                ):
+                    index.journal_md5 = journal_md5
+                else:
+                    # Entries of another instance came in; rebuild on next read
+                    self._index = None
+
+    async def _flush_later(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(self._write_delay)
+                try:
+                    await self.flush()
+                except Exception:
+                    # Entries stay pending and are retried after the next delay
+                    logger.exception("Не удалось сохранить журнал форм")
+        finally:
+            self._flusher = None
+
+    async def _read_head(self, file_info: dict) -> tuple[str, str]:
+        """(headRevisionId, text) straight from Drive, not from the caches."""
+        head = await self._drive.get_head_revision(file_info["id"])
+        revision_id = head["headRevisionId"]
+        content = await self._drive.download_revision(file_info["id"], revision_id)
+        return revision_id, content.decode("utf-8-sig")
+
+    def _remember_conflict(self, conflict: RevisionConflict, base_revision: str) -> None:
+        """Record the revision our write was laid over, to be merged into
+        every write of the file until one lands cleanly."""
+        if conflict.previous_id is None:
+            self._unlisted.setdefault(conflict.file_id, []).append(
+                (base_revision, conflict.revision_id)
+            )
+            return
+        overwritten = self._overwritten.setdefault(conflict.file_id, [])
+        if conflict.previous_id not in overwritten:
+            overwritten.append(conflict.previous_id)
+
+    async def _after_conflict(
+        self, file_info: dict, conflict: RevisionConflict
+    ) -> tuple[str, str]:
+        """(revision, text) to base the next attempt on: the revision our
+        write was laid over, or the head if it isn't known yet."""
+        await asyncio.sleep(random.uniform(0, MERGE_JITTER))
+        if conflict.previous_id is None:
+            return await self._read_head(file_info)
+        content = await self._drive.download_revision(file_info["id"], conflict.previous_id)
+        return conflict.revision_id, content.decode("utf-8-sig")
+
+    async def _resolve_unlisted(self, file_id: str) -> None:
+        """Find what our unlisted writes replaced, once the revision list
+        shows them."""
+        unlisted = self._unlisted.get(file_id)
+        if not unlisted:
+            return
+        revisions = await self._drive.list_revisions(file_id)
+        for base_revision, revision_id in list(unlisted):
+            if revision_id not in revisions:
+                continue
+            unlisted.remove((base_revision, revision_id))
+            position = revisions.index(revision_id)
+            previous_id = revisions[position - 1] if position > 0 else None
+            if previous_id is not None and previous_id != base_revision:
+                self._remember_conflict(
+                    RevisionConflict(file_id, revision_id, previous_id), base_revision
+                )
+        if not unlisted:
+            del self._unlisted[file_id]
+
+    async def _read_overwritten(self, file_info: dict) -> list[str]:
+        """Texts of the revisions our writes overwrote, oldest first. A
+        revision Drive no longer has is dropped: its entries are lost."""
+        file_id = file_info["id"]
+        await self._resolve_unlisted(file_id)
+        texts = []
+        for revision_id in list(self._overwritten.get(file_id, [])):
+            try:
+                content = await self._drive.download_revision(file_id, revision_id)
+            except DriveApiError as e:
+                if e.status not in (404, 410):
+                    raise
+                logger.error(
+                    "Формы: ревизия %s файла %s недоступна (%s), её записи потеряны",
+                    revision_id, file_id, e.status,
+                )
+                self._overwritten[file_id].remove(revision_id)
+                continue
+            texts.append(content.decode("utf-8-sig"))
+        return texts
+
+    async def _merge_journal(
+        self, add: list[dict], drop_ids: set[str]
+    ) -> tuple[str | None, list[dict]]:
+        """Rewrite the journal as Drive has it, without drop_ids and with
+        add appended. Returns (md5Checksum, entries written).
+
+        If another instance wrote in between, our write still replaced
+        theirs; their revision is read back and merged by entry id, and the
+        result written on top of ours. This repeats until a write lands
+        cleanly, at most MAX_MERGE_ATTEMPTS times; every revision
+        overwritten on the way is merged in, also by the next write if this
+        one fails."""
+        journal_file = await self._find_file(JOURNAL_FILENAME)
+        if not journal_file:
+            if not add:
+                return None, []
+            # Listing is dropped by the upload; the next read picks up the checksum
+            await self._create_file(_encode_journal(add), JOURNAL_FILENAME)
+            return None, list(add)
+        return await self._update_journal(journal_file, add, drop_ids)
 
-        data = buf.getvalue().encode("utf-8")
-        file_id = self._get_csv_file_id()
-        if not file_id:
+    async def _update_journal(
+        self, journal_file: dict, add: list[dict], drop_ids: set[str]
+    ) -> tuple[str | None, list[dict]]:
+        """_merge_journal on a journal file that exists."""
+        base_revision, text = await self._read_head(journal_file)
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            entries = _parse_journal(text)
+            for other in await self._read_overwritten(journal_file):
+                present = {e.get("id") for e in entries}
+                entries += [e for e in _parse_journal(other) if e.get("id") not in present]
+            present = {e.get("id") for e in entries}
+            merged = [e for e in entries if e.get("id") not in drop_ids]
+            merged += [e for e in add if e["id"] not in present]
+            try:
+                result = await self._drive.update_file(
+                    journal_file["id"], _encode_journal(merged), JOURNAL_MIME,
+                    base_revision=base_revision,
+                )
+            except RevisionConflict as conflict:
+                self._remember_conflict(conflict, base_revision)
+                if attempt + 1 == MAX_MERGE_ATTEMPTS:
+                    raise
+                logger.info("Журнал форм изменён другим экземпляром, объединяю")
+                base_revision, text = await self._after_conflict(journal_file, conflict)
+                continue
+            self._overwritten.pop(journal_file["id"], None)
+            return result.get("md5Checksum"), merged
+
+    async def _read_journal(self, pending: list[dict]) -> list[dict]:
+        """The journal as Drive has it now, followed by the pending entries
+        that have not reached it yet."""
+        journal_file = await self._find_file(JOURNAL_FILENAME)
+        journal = []
+        if journal_file:
+            journal = _parse_journal((await self._read_head(journal_file))[1])
+        persisted = {entry.get("id") for entry in journal}
+        return journal + [entry for entry in pending if entry["id"] not in persisted]
+
+    async def _write_csv(
+        self, journal: list[dict], pending: list[dict]
+    ) -> tuple[str | None, list[Form], list[dict]]:
+        """Fold journal into the CSV as Drive has it. Returns (md5Checksum,
+        rows written, journal entries folded in).
+
+        On a conflict the other instance's CSV becomes the base, and the
+        journal is read again: that instance may have folded entries and
+        dropped them from the journal. Replaying our older copy of them
+        could bring back a version it has folded and then deleted, since a
+        create can't tell "not folded yet" from "folded and deleted"."""
+        csv_file = await self._find_file(CSV_FILENAME)
+        if not csv_file and self._create_missing:
+            rows = _FormIndex([], None, journal).rows
+            await self._create_file(_encode_csv(rows), CSV_FILENAME)
+            return None, rows, journal
+        if not csv_file:
             raise FileNotFoundError(
                 f"Файл «{CSV_FILENAME}» не найден на Google Drive. "
                 "Создайте его вручную в корневой папке."
             )
-        self._drive.update_file(file_id, data, CSV_MIME)
+        return await self._update_csv(csv_file, journal, pending)
+
+    async def _update_csv(
+        self,
+        csv_file: dict,
+        journal: list[dict],
+        pending: list[dict],
+        extra_rows: list[Form] | None = None,
+    ) -> tuple[str | None, list[Form], list[dict]]:
+        """_write_csv on a CSV file that exists; extra_rows are added to it
+        unless it has them already. An empty journal is not re-read."""
+        base_revision, text = await self._read_head(csv_file)
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            base_rows = _parse_csv(text)
+            for other in await self._read_overwritten(csv_file):
+                base_rows = _union_rows(base_rows, _parse_csv(other))
+            base_rows = _union_rows(base_rows, extra_rows or [])
+            rows = _FormIndex(base_rows, None, journal).rows
+            try:
+                result = await self._drive.update_file(
+                    csv_file["id"], _encode_csv(rows), CSV_MIME,
+                    base_revision=base_revision,
+                )
+            except RevisionConflict as conflict:
+                self._remember_conflict(conflict, base_revision)
+                if attempt + 1 == MAX_MERGE_ATTEMPTS:
+                    raise
+                logger.info("Файл форм изменён другим экземпляром, объединяю")
+                base_revision, text = await self._after_conflict(csv_file, conflict)
+                if journal:
+                    journal = await self._read_journal(pending)
+                continue
+            self._overwritten.pop(csv_file["id"], None)
+            return result.get("md5Checksum"), rows, journal
+
+    async def _create_file(self, data: bytes, filename: str) -> None:
+        """Upload a new storage file. Another instance may have created the
+        same file meanwhile; then the oldest copy is kept, the entries of
+        the others are merged into it and they go to the trash. Every
+        instance reads and writes the oldest copy (find_file_by_name)."""
+        await self._drive.upload_file(data, filename, self._folder_id)
+        copies = await self._drive.list_files_by_name(self._folder_id, filename)
+        if len(copies) < 2:
+            return
+
+        keep, extra = copies[0], copies[1:]
+        logger.warning(
+            "Формы: «%s» создан дважды (%d копий), объединяю в самую старую",
+            filename, len(copies),
+        )
+        texts = [(await self._read_head(f))[1] for f in extra]
+        if filename == JOURNAL_FILENAME:
+            add = [entry for text in texts for entry in _parse_journal(text)]
+            await self._update_journal(keep, add, set())
+        else:
+            rows = [r for text in texts for r in _parse_csv(text)]
+            await self._update_csv(keep, [], [], rows)
+        for f in extra:
+            await self._drive.trash_file(f["id"], self._folder_id)
+
+    async def compact(self) -> None:
+        """Fold the journal into формы.csv and drop the folded entries from
+        it. The CSV is written first: replaying entries that are already
+        folded in is a no-op, so a failure in between loses nothing."""
+        async with self._write_lock:
+            async with self._lock:
+                pending = list(self._pending)
+            journal = await self._read_journal(pending)
+            if not journal:
+                return
+
+            try:
+                csv_md5, rows, journal = await self._write_csv(journal, pending)
+                folded = {entry.get("id") for entry in journal}
+                journal_md5, remaining = await self._merge_journal([], folded)
+            except BaseException:
+                self._index = None
+                raise
+
+            async with self._lock:
+                # Folded pending edits are in the CSV now; edits made during
+                # compaction stay pending
+                self._pending = [e for e in self._pending if e["id"] not in folded]
+                self._index = _FormIndex(
+                    rows, csv_md5, remaining + self._pending, journal_md5
+                )
+            logger.info("Формы: журнал (%d записей) перенесён в CSV", len(journal))
+
+    async def find(self, folder_id: str, folder_name: str) -> list[Form]:
+        async with self._lock:
+            index = await self._load_index()
+        return list(index.find(folder_id, folder_name))
+
+    async def create(
+        self, folder_id: str, folder_name: str, content: str, author: str, note: str,
+    ) -> Form:
+        async with self._lock:
+            index = await self._load_index()
+            existing = index.find(folder_id, folder_name)
+            next_ver = max((e.version for e in existing), default=0) + 1
+            self._append(
+                index, "create",
+                folder_id=folder_id, folder_name=folder_name, version=next_ver,
+                content=content, author=author, note=note,
+            )
+            form = index.get(folder_id, next_ver)
+        await self._write_through()
+        return form
+
+    async def edit(
+        self, folder_id: str, version: int, content: str, note: str, author: str,
+    ) -> Form | None:
+        async with self._lock:
+            index = await self._load_index()
+            form = index.get(folder_id, version)
+            if form is None:
+                return None
+            self._append(
+                index, "edit",
+                folder_id=folder_id, version=version, created_at=form.created_at,
+                content=content, note=note, author=author,
+            )
+        await self._write_through()
+        return form
+
+    async def delete(self, folder_id: str, version: int) -> bool:
+        async with self._lock:
+            index = await self._load_index()
+            target = index.get(folder_id, version)
+            if target is None:
+                return False
+            self._append(
+                index, "delete",
+                folder_id=folder_id, version=version, created_at=target.created_at,
+            )
+        await self._write_through()
+        return True
+
+    async def toggle_pin(self, folder_id: str, version: int) -> bool:
+        async with self._lock:
+            index = await self._load_index()
+            target = index.get(folder_id, version)
+            if not target:
+                return False
+
+            self._append(
+                index, "pin",
+                folder_id=folder_id, version=version, created_at=target.created_at,
+                pinned=not target.pinned,
+            )
+            pinned = target.pinned
+        await self._write_through()
+        return pinned
+
+
+class FormService:
+    """Form versions of every folder (see _FormStore for the file format).
+
+    storage="single" keeps all forms in one формы.csv in the root folder.
+    storage="sharded" keeps each folder's forms in its own формы.csv inside
+    that folder, so reads and writes touch only that shard;
+    migrate_forms.py moves an existing single file into shards.
+
+    A background task compacts journals every compact_interval seconds, or
+    sooner once one reaches journal_max_entries."""
+
+    def __init__(
+        self,
+        drive: DriveService,
+        root_folder_id: str,
+        *,
+        storage: str = "single",
+        compact_interval: float = 600,
+        journal_max_entries: int = 50,
+        write_delay: float = 2,
+    ):
+        if storage not in STORAGE_MODES:
+            raise ValueError(
+                f"Неизвестный режим хранения форм {storage!r}, "
+                f"ожидается один из {STORAGE_MODES}"
+            )
+        self._drive = drive
+        self._root_folder_id = root_folder_id
+        self._storage = storage
+        self._journal_max_entries = journal_max_entries
+        self._write_delay = write_delay
+        # {folder_id holding the files: store}
+        self._stores: dict[str, _FormStore] = {}
+
+        self._compact_interval = compact_interval
+        self._compact_needed = asyncio.Event()
+        self._compactor: asyncio.Task | None = None
+
+    def _store(self, folder_id: str) -> _FormStore:
+        key = folder_id if self._storage == "sharded" else self._root_folder_id
+        store = self._stores.get(key)
+        if store is None:
+            store = self._stores[key] = _FormStore(
+                self._drive, key,
+                journal_max_entries=self._journal_max_entries,
+                write_delay=self._write_delay,
+                compact_needed=self._compact_needed,
+                create_missing=self._storage == "sharded",
+            )
+        return store
+
+    async def start(self):
+        self._compactor = asyncio.create_task(self._compact_loop())
+
+    async def close(self):
+        """Stop background tasks and write pending edits."""
+        if self._compactor is not None:
+            self._compactor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._compactor
+            self._compactor = None
+        for store in list(self._stores.values()):
+            try:
+                await store.close()
+            except Exception:
+                logger.exception("Не удалось сохранить журнал форм при остановке")
+
+    async def flush(self) -> None:
+        """Write pending journal entries of every store to Drive now. A
+        store that fails keeps its entries and does not stop the others."""
+        for store in list(self._stores.values()):
+            try:
+                await store.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить журнал форм")
 
-    def _filter(self, rows: list[Form], folder_id: str, folder_name: str) -> list[Form]:
-        by_id = [r for r in rows if r.folder_id == folder_id]
-        if by_id:
-            return by_id
-        return [r for r in rows if r.folder_name == folder_name]
+    async def compact(self) -> None:
+        """Fold the journals this instance knows about into their CSVs."""
+        for store in list(self._stores.values()):
+            if not store.has_journal:
+                continue
+            try:
+                await store.compact()
+            except Exception:
+                logger.exception("Не удалось перенести журнал форм в CSV")
+
+    async def _compact_loop(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._compact_needed.wait(), self._compact_interval)
+            self._compact_needed.clear()
+            await self.compact()
 
     @staticmethod
     def _sort_for_display(versions: list[Form]) -> list[Form]:
@@ -105,17 +805,15 @@ class FormService:
             return unpinned + pinned
         return unpinned
 
-    def get_versions(self, folder_id: str, folder_name: str) -> list[Form]:
-        with self._lock:
-            rows = self._load_csv()
-        matched = self._filter(rows, folder_id, folder_name)
-        return self._sort_for_display(matched)
+    async def get_versions(self, folder_id: str, folder_name: str) -> list[Form]:
+        versions = await self._store(folder_id).find(folder_id, folder_name)
+        return self._sort_for_display(versions)
 
-    def get_latest_version(self, folder_id: str, folder_name: str) -> Form | None:
-        versions = self.get_versions(folder_id, folder_name)
+    async def get_latest_version(self, folder_id: str, folder_name: str) -> Form | None:
+        versions = await self.get_versions(folder_id, folder_name)
         return versions[0] if versions else None
 
-    def create_version(
+    async def create_version(
         self,
         folder_id: str,
         folder_name: str,
@@ -123,30 +821,11 @@ class FormService:
         author: str,
         note: str = "",
     ) -> Form:
-        with self._lock:
-            rows = self._load_csv()
-            existing = self._filter(rows, folder_id, folder_name)
-            for e in existing:
-                e.pinned = False
-            next_ver = max((e.version for e in existing), default=0) + 1
-            now = datetime.now(timezone.utc).isoformat()
-
-            entry = Form(
-                folder_id=folder_id,
-                folder_name=folder_name,
-                version=next_ver,
-                content=content,
-                author=author,
-                created_at=now,
-                updated_at=now,
-                note=note,
-                pinned=False,
-            )
-            rows.append(entry)
-            self._save_csv(rows)
-        return entry
+        return await self._store(folder_id).create(
+            folder_id, folder_name, content, author, note,
+        )
 
-    def edit_version(
+    async def edit_version(
         self,
         folder_id: str,
         version: int,
@@ -154,52 +833,12 @@ class FormService:
         note: str,
         author: str,
     ) -> Form | None:
-        with self._lock:
-            rows = self._load_csv()
-            for r in rows:
-                if r.folder_id == folder_id and r.version == version:
-                    r.content = content
-                    r.note = note
-                    r.author = author
-                    r.updated_at = datetime.now(timezone.utc).isoformat()
-                    self._save_csv(rows)
-                    return r
-        return None
+        return await self._store(folder_id).edit(folder_id, version, content, note, author)
 
-    def delete_version(self, folder_id: str, version: int) -> bool:
-        with self._lock:
-            rows = self._load_csv()
-            new_rows = [
-                r for r in rows
-                if not (r.folder_id == folder_id and r.version == version)
-            ]
-            if len(new_rows) == len(rows):
-                return False
-            self._save_csv(new_rows)
-        return True
+    async def delete_version(self, folder_id: str, version: int) -> bool:
+        return await self._store(folder_id).delete(folder_id, version)
 
-    def toggle_pin(self, folder_id: str, version: int) -> bool:
+    async def toggle_pin(self, folder_id: str, version: int) -> bool:
         """Pin version if not pinned (unpins others), unpin if already pinned.
         Returns new pinned state."""
-        with self._lock:
-            rows = self._load_csv()
-            target = None
-            folder_rows = []
-            for r in rows:
-                if r.folder_id == folder_id:
-                    folder_rows.append(r)
-                    if r.version == version:
-                        target = r
-
-            if not target:
-                return False
-
-            if target.pinned:
-                target.pinned = False
-            else:
-                for r in folder_rows:
-                    r.pinned = False
-                target.pinned = True
-
-            self._save_csv(rows)
-            return target.pinned
+        return await self._store(folder_id).toggle_pin(folder_id, version)
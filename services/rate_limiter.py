@@ -0,0 +1,63 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+# Lower value is served first
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket:
+    """Async token bucket shared by all callers of one quota.
+
+    Refills at `rate` tokens per second up to `capacity`. Waiting callers
+    are served by priority, then in arrival order, so an interactive
+    request overtakes a queue of bulk downloads."""
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        # heap of (priority, seq, future)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.TimerHandle | None = None
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def _dispatch(self):
+        self._wakeup = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():  # waiter was cancelled
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._waiters:
+            delay = (1 - self._tokens) / self._rate
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._wakeup is None:
+            self._dispatch()
+        if fut.done():
+            return
+
+        started = time.monotonic()
+        await fut
+        self.waits += 1
+        self.wait_seconds += time.monotonic() - started
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import random
+from collections import Counter
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+    # Upper bound for a server-provided Retry-After
+    max_retry_after: float = 60
+
+    def backoff(self, retry_number: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry_number))
+
+    def delay(self, retry_number: int, retry_after: float | None) -> float:
+        delay = self.backoff(retry_number)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+class RetryMetrics:
+    """Retry counters per error class."""
+
+    def __init__(self):
+        self.retries: Counter[str] = Counter()
+        self.give_ups: Counter[str] = Counter()
+        self.recovered: Counter[str] = Counter()
+        self.sleep_seconds = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "retries": dict(self.retries),
+            "give_ups": dict(self.give_ups),
+            "recovered": dict(self.recovered),
+            "sleep_seconds": round(self.sleep_seconds, 1),
+        }
+
+
+async def retry(func, *, classify, policies: dict[str, RetryPolicy], metrics: RetryMetrics):
+    """Await func() until it succeeds or the error's policy gives up.
+
+    classify(exc) names the error class ("connection", "rate_limit", ...)
+    or returns None for errors that must not be retried. Sleeps are
+    asyncio.sleep, so waiting never blocks the event loop."""
+    retry_number = 0
+    last_class = None
+    while True:
+        try:
+            result = await func()
+        except Exception as e:
+            error_class = classify(e)
+            policy = policies.get(error_class)
+            if policy is None:
+                raise
+            if retry_number + 1 >= policy.max_attempts:
+                metrics.give_ups[error_class] += 1
+                raise
+
+            delay = policy.delay(retry_number, getattr(e, "retry_after", None))
+            retry_number += 1
+            last_class = error_class
+            metrics.retries[error_class] += 1
+            metrics.sleep_seconds += delay
+            logger.warning("%s error (attempt %d/%d), retrying in %.1fs: %s",
+                           error_class, retry_number, policy.max_attempts, delay, e)
+            await asyncio.sleep(delay)
+            continue
+
+        if last_class is not None:
+            metrics.recovered[last_class] += 1
+        return result
@@ -0,0 +1,107 @@
+import asyncio
+import contextlib
+import os
+import tempfile
+import zipfile
+import zlib
+
+# Formats that are compressed already: deflating them only burns CPU
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".mp4", ".mov", ".webm", ".mkv",
+    ".zip", ".rar", ".7z", ".gz", ".bz2", ".xz",
+    ".mxl", ".docx", ".xlsx", ".pptx", ".odt",
+}
+# Anything else (PDFs, text, unknown types) is judged by a sample: PDF
+# streams are usually deflated already, but scans and exports vary
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVINGS = 0.1
+COMPRESS_LEVEL = 6
+
+
+def choose_compression(name: str, content: bytes) -> tuple[int, int | None]:
+    """(compress_type, compresslevel) for one archive entry."""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in STORED_EXTENSIONS or not content:
+        return zipfile.ZIP_STORED, None
+
+    sample = content[:SAMPLE_SIZE]
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > 1 - MIN_SAVINGS:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, COMPRESS_LEVEL
+
+
+class ZipArchive:
+    """ZIP archive written entry by entry to a temporary file on disk.
+
+    Peak memory is one entry, not the whole archive; send it with
+    aiogram's FSInputFile(archive.path) and remove() it afterwards.
+    Compression runs in a worker thread, off the event loop."""
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix=".zip")
+        self._file = os.fdopen(fd, "w+b")
+        self._zip = zipfile.ZipFile(self._file, "w")
+        # ZipFile is not safe for concurrent writers
+        self._lock = asyncio.Lock()
+        self.count = 0
+
+    def _write(self, name: str, content: bytes):
+        compress_type, level = choose_compression(name, content)
+        self._zip.writestr(name, content, compress_type=compress_type,
+                           compresslevel=level)
+
+    async def add(self, name: str, content: bytes):
+        async with self._lock:
+            await asyncio.to_thread(self._write, name, content)
+            self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._zip.close()
+            self._file.close()
+
+    def remove(self):
+        self.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+# Local header + central directory record, without the name
+ENTRY_OVERHEAD = 76
+
+
+def plan_volumes(
+    folders: list[tuple[str, list[dict]]], max_bytes: int
+) -> list[list[tuple[str, dict]]]:
+    """Split (folder_name, files) into volumes of at most max_bytes.
+
+    Sizes come from the Drive listing and ignore compression, so a volume
+    never ends up larger than planned. A folder is kept in one volume when
+    it fits into one; a bigger folder is cut file by file. A single file
+    over the limit still gets a volume of its own."""
+    volumes: list[list[tuple[str, dict]]] = []
+    current: list[tuple[str, dict]] = []
+    current_size = 0
+
+    def entry_size(folder_name: str, file_meta: dict) -> int:
+        path = f"{folder_name}/{file_meta['name']}".encode("utf-8")
+        return int(file_meta.get("size", 0)) + ENTRY_OVERHEAD + 2 * len(path)
+
+    for folder_name, files in folders:
+        sizes = [entry_size(folder_name, f) for f in files]
+        folder_size = sum(sizes)
+        if current and current_size + folder_size > max_bytes and folder_size <= max_bytes:
+            volumes.append(current)
+            current, current_size = [], 0
+        for file_meta, size in zip(files, sizes):
+            if current and current_size + size > max_bytes:
+                volumes.append(current)
+                current, current_size = [], 0
+            current.append((folder_name, file_meta))
+            current_size += size
+    if current:
+        volumes.append(current)
+    return volumes
@@ -0,0 +1,113 @@
+"""In-memory stand-in for DriveService, enough for the form storage.
+
+Files keep every revision, like Drive does. A test can make another
+instance act "in between" by setting on_write: it is awaited once, right
+before the next upload or update lands. Setting lag_next_write keeps the
+next update out of the revision list until another write, as Drive's
+list sometimes lags behind."""
+
+import hashlib
+import itertools
+
+from services.drive_service import DriveApiError, RevisionConflict
+
+
+class FakeDrive:
+    def __init__(self):
+        self.files: dict[str, dict] = {}
+        self.on_write = None
+        self.conflicts = 0
+        self.lag_next_write = False
+        self._unlisted: set[str] = set()
+        self._ids = itertools.count(1)
+
+    # ── Test helpers ──
+
+    def add_file(self, folder_id: str, name: str, content: bytes) -> str:
+        file_id = f"f{next(self._ids)}"
+        self.files[file_id] = {
+            "name": name, "folder": folder_id, "created": next(self._ids),
+            "trashed": False, "revisions": [(f"r{next(self._ids)}", content)],
+        }
+        return file_id
+
+    def copies(self, folder_id: str, name: str) -> list[str]:
+        """Ids of live files with this name, oldest first."""
+        return sorted(
+            (fid for fid, f in self.files.items()
+             if f["folder"] == folder_id and f["name"] == name and not f["trashed"]),
+            key=lambda fid: self.files[fid]["created"],
+        )
+
+    def text(self, folder_id: str, name: str) -> str:
+        (file_id,) = self.copies(folder_id, name)
+        return self.files[file_id]["revisions"][-1][1].decode("utf-8-sig")
+
+    def purge_revision(self, file_id: str, revision_id: str) -> None:
+        revisions = self.files[file_id]["revisions"]
+        revisions[:] = [(rid, content) for rid, content in revisions if rid != revision_id]
+
+    async def _before_write(self):
+        if self.on_write is not None:
+            hook, self.on_write = self.on_write, None
+            await hook()
+
+    def _info(self, file_id: str) -> dict:
+        f = self.files[file_id]
+        return {
+            "id": file_id, "name": f["name"],
+            "createdTime": f"{f['created']:08d}",
+            "md5Checksum": hashlib.md5(f["revisions"][-1][1]).hexdigest(),
+        }
+
+    # ── DriveService API ──
+
+    async def find_file_by_name(self, folder_id: str, filename: str) -> dict | None:
+        copies = self.copies(folder_id, filename)
+        return self._info(copies[0]) if copies else None
+
+    async def list_files_by_name(self, folder_id: str, filename: str) -> list[dict]:
+        return [self._info(fid) for fid in self.copies(folder_id, filename)]
+
+    async def download_file(self, file_id: str, **_) -> tuple[bytes, str]:
+        f = self.files[file_id]
+        return f["revisions"][-1][1], f["name"]
+
+    async def get_head_revision(self, file_id: str) -> dict:
+        return {**self._info(file_id), "headRevisionId": self.files[file_id]["revisions"][-1][0]}
+
+    async def list_revisions(self, file_id: str) -> list[str]:
+        return [rid for rid, _ in self.files[file_id]["revisions"] if rid not in self._unlisted]
+
+    async def download_revision(self, file_id: str, revision_id: str) -> bytes:
+        revisions = dict(self.files[file_id]["revisions"])
+        if revision_id not in revisions:
+            raise DriveApiError(404, f"Revision not found: {revision_id}")
+        return revisions[revision_id]
+
+    async def upload_file(self, content: bytes, filename: str, folder_id: str) -> dict:
+        await self._before_write()
+        file_id = self.add_file(folder_id, filename, content)
+        return {"id": file_id, "name": filename}
+
+    async def update_file(
+        self, file_id: str, content: bytes, mime_type: str, *, base_revision=None,
+    ) -> dict:
+        await self._before_write()
+        self._unlisted.clear()
+        revision_id = f"r{next(self._ids)}"
+        self.files[file_id]["revisions"].append((revision_id, content))
+        if self.lag_next_write:
+            self.lag_next_write = False
+            self._unlisted.add(revision_id)
+        # As DriveService: the revision before ours, as far as the list shows
+        listed = await self.list_revisions(file_id)
+        position = listed.index(revision_id) if revision_id in listed else 0
+        previous_id = listed[position - 1] if position > 0 else None
+        if base_revision is not None and previous_id != base_revision:
+            self.conflicts += 1
+            raise RevisionConflict(file_id, revision_id, previous_id)
+        return {**self._info(file_id), "headRevisionId": revision_id}
+
+    async def trash_file(self, file_id: str, folder_id: str) -> None:
+        self.files[file_id]["trashed"] = True
@@ -0,0 +1,266 @@
+import unittest
+from dataclasses import astuple
+from unittest import mock
+
+from services.form_service import (
+    CSV_FILENAME,
+    JOURNAL_FILENAME,
+    MAX_MERGE_ATTEMPTS,
+    FormService,
+    _encode_csv,
+    _FormIndex,
+    _parse_csv,
+    _parse_journal,
+)
+from tests.fake_drive import FakeDrive
+
+ROOT = "root"
+
+
+def forms(drive: FakeDrive, folder_id: str = ROOT) -> list[tuple]:
+    """(folder, version, content) as another instance would read them."""
+    csv_text = drive.text(folder_id, CSV_FILENAME) if drive.copies(folder_id, CSV_FILENAME) else ""
+    journal = []
+    if drive.copies(folder_id, JOURNAL_FILENAME):
+        journal = _parse_journal(drive.text(folder_id, JOURNAL_FILENAME))
+    rows = _FormIndex(_parse_csv(csv_text), None, journal).rows
+    return sorted((r.folder_id, r.version, r.content) for r in rows)
+
+
+def entry(entry_id: str, op: str, at: str, version: int = 1, **values) -> dict:
+    return {
+        "id": entry_id, "op": op, "at": at, "folder_id": "A", "folder_name": "a",
+        "version": version, "content": "", "author": "u", "note": "", **values,
+    }
+
+
+JOURNAL = [
+    entry("1", "create", "t1", content="v1"),
+    entry("2", "create", "t2", version=2, content="v2"),
+    entry("3", "edit", "t3", content="v1 edited"),
+    entry("4", "pin", "t4", pinned=True),
+    entry("5", "create", "t5", version=3, content="v3"),
+    entry("6", "delete", "t6", version=2),
+    entry("7", "pin", "t7", version=3, pinned=True),
+]
+
+
+class FormIndexTest(unittest.TestCase):
+    def rows(self, index: _FormIndex) -> list[tuple]:
+        return sorted(astuple(r) for r in index.rows)
+
+    def test_replay_over_folded_csv_changes_nothing(self):
+        folded = _FormIndex([], None, JOURNAL)
+        csv_rows = _parse_csv(_encode_csv(folded.rows).decode("utf-8-sig"))
+        replayed = _FormIndex(csv_rows, None, JOURNAL)
+        self.assertEqual(self.rows(replayed), self.rows(folded))
+
+    def test_replaying_entries_twice_changes_nothing(self):
+        once = _FormIndex([], None, JOURNAL)
+        twice = _FormIndex([], None, JOURNAL + JOURNAL)
+        self.assertEqual(self.rows(twice), self.rows(once))
+        self.assertEqual(
+            [(r.version, r.content, r.pinned) for r in once.rows],
+            [(1, "v1 edited", False), (3, "v3", True)],
+        )
+
+    def test_folded_create_does_not_unpin(self):
+        # The pin that followed the create is folded in and gone from the journal
+        folded = _FormIndex([], None, JOURNAL)
+        replayed = _FormIndex(folded.rows, None, JOURNAL[4:5])
+        self.assertEqual(
+            [(r.version, r.pinned) for r in replayed.rows], [(1, False), (3, True)]
+        )
+
+    def test_concurrent_creates_of_one_version_are_renumbered(self):
+        index = _FormIndex([], None, [
+            entry("1", "create", "t1", content="mine"),
+            entry("2", "create", "t2", content="theirs"),
+        ])
+        self.assertEqual(
+            sorted((r.version, r.content) for r in index.rows),
+            [(1, "mine"), (2, "theirs")],
+        )
+
+
+class MergeJournalTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = mock.patch("services.form_service.MERGE_JITTER", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.drive = FakeDrive()
+        self.drive.add_file(ROOT, CSV_FILENAME, b"")
+        self.drive.add_file(ROOT, JOURNAL_FILENAME, b"")
+        self.a = FormService(self.drive, ROOT, write_delay=60)
+        self.b = FormService(self.drive, ROOT, write_delay=0)
+        self.c = FormService(self.drive, ROOT, write_delay=0)
+
+    async def asyncTearDown(self):
+        for service in (self.a, self.b, self.c):
+            await service.close()
+
+    async def test_conflict_merges_the_overwritten_revision(self):
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = lambda: self.b.create_version("B", "b", "from-b", "u")
+        await self.a.flush()
+
+        self.assertEqual(self.drive.conflicts, 1)
+        self.assertEqual(forms(self.drive), [("A", 1, "from-a"), ("B", 1, "from-b")])
+
+    async def test_every_overwritten_revision_is_merged(self):
+        async def c_writes_over_our_first_write():
+            # C reads our unmerged write (without B's entry) and writes on top
+            await self.c.create_version("C", "c", "from-c", "u")
+
+        async def b_writes():
+            await self.b.create_version("B", "b", "from-b", "u")
+            self.drive.on_write = c_writes_over_our_first_write
+
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = b_writes
+        await self.a.flush()
+
+        self.assertEqual(self.drive.conflicts, 2)
+        self.assertEqual(
+            forms(self.drive),
+            [("A", 1, "from-a"), ("B", 1, "from-b"), ("C", 1, "from-c")],
+        )
+
+    async def test_failed_merge_is_finished_by_the_next_flush(self):
+        async def fail():
+            raise ConnectionError("network down")
+
+        async def b_writes():
+            await self.b.create_version("B", "b", "from-b", "u")
+            self.drive.on_write = fail
+
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = b_writes
+        with self.assertLogs("services.form_service", "ERROR"):
+            await self.a.flush()
+        # Head is our write, without B's entry
+        self.assertEqual(forms(self.drive), [("A", 1, "from-a")])
+
+        await self.a.flush()
+        self.assertEqual(forms(self.drive), [("A", 1, "from-a"), ("B", 1, "from-b")])
+
+    async def test_purged_overwritten_revision_is_dropped(self):
+        async def fail():
+            raise ConnectionError("network down")
+
+        async def b_writes():
+            await self.b.create_version("B", "b", "from-b", "u")
+            self.drive.on_write = fail
+
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = b_writes
+        with self.assertLogs("services.form_service", "ERROR"):
+            await self.a.flush()
+        (journal_id,) = self.drive.copies(ROOT, JOURNAL_FILENAME)
+        self.drive.purge_revision(journal_id, self.drive.files[journal_id]["revisions"][-2][0])
+
+        with self.assertLogs("services.form_service", "ERROR") as logs:
+            await self.a.flush()
+        self.assertIn("недоступна", logs.output[0])
+        await self.a.create_version("A", "a", "again", "u")
+        with self.assertNoLogs("services.form_service", "ERROR"):
+            await self.a.flush()
+        self.assertEqual(forms(self.drive), [("A", 1, "from-a"), ("A", 2, "again")])
+
+    async def test_merge_gives_up_after_max_attempts(self):
+        async def b_writes():
+            await self.b.create_version("B", "b", "from-b", "u")
+            self.drive.on_write = b_writes
+
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = b_writes
+        with self.assertLogs("services.form_service", "ERROR"):
+            await self.a.flush()
+        self.assertEqual(self.drive.conflicts, MAX_MERGE_ATTEMPTS)
+
+        self.drive.on_write = None
+        await self.a.flush()
+        self.assertEqual(
+            forms(self.drive),
+            [("A", 1, "from-a")] + [("B", v, "from-b") for v in range(1, MAX_MERGE_ATTEMPTS + 1)],
+        )
+
+    async def test_write_missing_from_revision_list_is_merged_later(self):
+        async def b_writes():
+            await self.b.create_version("B", "b", "from-b", "u")
+            self.drive.lag_next_write = True
+
+        await self.a.create_version("A", "a", "from-a", "u")
+        self.drive.on_write = b_writes
+        await self.a.flush()
+        # What our first write replaced is unknown until the list shows it
+        self.assertEqual(forms(self.drive), [("A", 1, "from-a")])
+
+        await self.a.create_version("A", "a", "again", "u")
+        await self.a.flush()
+        self.assertEqual(
+            forms(self.drive), [("A", 1, "from-a"), ("A", 2, "again"), ("B", 1, "from-b")]
+        )
+
+    async def test_edit_follows_its_version_when_renumbered(self):
+        await self.a.create_version("A", "a", "from-a", "u")
+        await self.a.edit_version("A", 1, "from-a edited", "", "u")
+        # B takes version 1 first; A's create is renumbered to 2 on replay
+        self.drive.on_write = lambda: self.b.create_version("A", "a", "from-b", "u")
+        await self.a.flush()
+
+        self.assertEqual(forms(self.drive), [("A", 1, "from-b"), ("A", 2, "from-a edited")])
+        versions = await self.a.get_versions("A", "a")
+        self.assertEqual([(v.version, v.content) for v in versions],
+                         [(1, "from-b"), (2, "from-a edited")])
+
+    async def test_version_deleted_during_compaction_stays_deleted(self):
+        async def b_deletes_and_compacts():
+            await self.b.delete_version("A", 1)
+            await self.b.compact()
+
+        await self.a.create_version("A", "a", "v1", "u")
+        await self.a.flush()
+        # A has read the journal with the create; B's delete is folded and
+        # dropped from the journal before A's CSV write lands
+        self.drive.on_write = b_deletes_and_compacts
+        await self.a.compact()
+
+        self.assertEqual(forms(self.drive), [])
+        self.assertEqual(_parse_journal(self.drive.text(ROOT, JOURNAL_FILENAME)), [])
+
+
+class DuplicateFilesTest(unittest.IsolatedAsyncioTestCase):
+    async def test_journal_created_twice_is_merged_into_oldest(self):
+        drive = FakeDrive()
+        drive.add_file(ROOT, CSV_FILENAME, b"")
+        a = FormService(drive, ROOT, write_delay=0)
+        b = FormService(drive, ROOT, write_delay=0)
+        await a.get_versions("A", "a")
+        await b.get_versions("B", "b")
+
+        # Both see no journal; B's copy lands first
+        drive.on_write = lambda: b.create_version("B", "b", "from-b", "u")
+        await a.create_version("A", "a", "from-a", "u")
+
+        self.assertEqual(len(drive.copies(ROOT, JOURNAL_FILENAME)), 1)
+        self.assertEqual(forms(drive), [("A", 1, "from-a"), ("B", 1, "from-b")])
+
+    async def test_shard_csv_created_twice_is_merged_into_oldest(self):
+        drive = FakeDrive()
+        a = FormService(drive, ROOT, storage="sharded", write_delay=0)
+        b = FormService(drive, ROOT, storage="sharded", write_delay=0)
+        await a.create_version("A", "a", "v1", "u")
+        await b.create_version("A", "a", "v2", "u")
+
+        # Both compact a shard that has no CSV yet
+        drive.on_write = b.compact
+        await a.compact()
+
+        self.assertEqual(len(drive.copies("A", CSV_FILENAME)), 1)
+        self.assertEqual(forms(drive, "A"), [("A", 1, "v1"), ("A", 2, "v2")])
+        self.assertEqual(_parse_journal(drive.text("A", JOURNAL_FILENAME)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()